@@ -1,37 +1,241 @@
-from openai import OpenAI
-import base64
+import time
+import httpx
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
 from tenacity import (
     retry,
+    retry_if_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )  # for exponential backoff
+from GPT.image_cache import ImageEncoder
+from GPT.rate_limiter import estimate_tokens
+from GPT.backends import OpenAIBackend, completion_payload
+from GPT.streaming import StreamedCompletion, drain_in_background, adrain_in_background
 
 
 generation_key = "xxxxx"  # GPT key
-client = OpenAI(
+# the LLM backend of every gpt_infer call, see GPT/backends.py
+backend = OpenAIBackend(
     api_key=generation_key,
 )
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def completion_with_backoff(**kwargs):
-    return client.chat.completions.create(**kwargs)
+def set_backend(llm_backend):
+    global backend
+    backend = llm_backend
 
 
-def gpt_infer(system, text, image_list, model="gpt-4-vision-preview", max_tokens=600, response_format=None):
+def get_backend():
+    return backend
 
+
+# USD per 1M (prompt, completion) tokens
+MODEL_PRICES = {
+    'gpt-4-vision-preview': (10., 30.),
+    'gpt-4-turbo': (10., 30.),
+    'gpt-4o-2024-05-13': (5., 15.),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4o': (2.5, 10.),
+}
+
+
+# prompt tokens served from the provider-side prompt cache are billed at a discount
+CACHED_PROMPT_DISCOUNT = 0.5
+
+
+def token_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    ''' Cost of a request in USD, None for a model missing from MODEL_PRICES '''
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # dated snapshots fall back to the longest matching model name
+        names = [name for name in MODEL_PRICES if model.startswith(name)]
+        if len(names) == 0:
+            return None
+        prices = MODEL_PRICES[max(names, key=len)]
+    prompt_tokens -= cached_tokens * CACHED_PROMPT_DISCOUNT
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1e6
+
+
+# optional persistent response cache, see GPT/cache.py
+response_cache = None
+
+
+def set_response_cache(cache):
+    global response_cache
+    response_cache = cache
+
+
+# images are re-sent at every step, so their base64 payloads are cached
+image_encoder = ImageEncoder()
+
+
+def set_image_encoder(encoder):
+    global image_encoder
+    image_encoder = encoder
+
+
+# optional limiter shared by all gpt_infer calls (and processes), see GPT/rate_limiter.py
+request_limiter = None
+
+
+def set_request_limiter(limiter):
+    global request_limiter
+    request_limiter = limiter
+
+
+# transient failures: rate limits, timeouts, connection and 5xx errors (also while reading a stream).
+# Deterministic ones, e.g. a request missing from a replayed transcript, are raised at once.
+TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, InternalServerError, httpx.TransportError)
+retry_transient = retry(retry=retry_if_exception_type(TRANSIENT_ERRORS),
+                        wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
+
+
+@retry_transient
+def completion_with_backoff(request_tokens=0, stats=None, **kwargs):
+    if stats is not None:
+        stats['attempts'] = stats.get('attempts', 0) + 1
+    if request_limiter is None:
+        return backend.complete(**kwargs)[0]
+
+    tic = time.time()
+    request_limiter.acquire(request_tokens)
+    if stats is not None:
+        stats['limit_wait'] = stats.get('limit_wait', 0.) + time.time() - tic
+    try:
+        chat_message, headers = backend.complete(**kwargs)
+    except RateLimitError as e:
+        request_limiter.release(e.response.headers, rate_limited=True)
+        raise
+    except BaseException:
+        request_limiter.release()
+        raise
+    request_limiter.release(headers)
+    return chat_message
+
+
+@retry_transient
+async def acompletion_with_backoff(request_tokens=0, stats=None, **kwargs):
+    if stats is not None:
+        stats['attempts'] = stats.get('attempts', 0) + 1
+    if request_limiter is None:
+        return (await backend.acomplete(**kwargs))[0]
+
+    tic = time.time()
+    await request_limiter.aacquire(request_tokens)
+    if stats is not None:
+        stats['limit_wait'] = stats.get('limit_wait', 0.) + time.time() - tic
+    try:
+        chat_message, headers = await backend.acomplete(**kwargs)
+    except RateLimitError as e:
+        request_limiter.release(e.response.headers, rate_limited=True)
+        raise
+    except BaseException:
+        request_limiter.release()
+        raise
+    request_limiter.release(headers)
+    return chat_message
+
+
+@retry_transient
+def open_stream(request_tokens=0, stats=None, **kwargs):
+    ''' Start a streamed completion and read it until its action is final, the limiter is released by finish_stream '''
+    if stats is not None:
+        stats['attempts'] = stats.get('attempts', 0) + 1
+    if request_limiter is not None:
+        tic = time.time()
+        request_limiter.acquire(request_tokens)
+        if stats is not None:
+            stats['limit_wait'] = stats.get('limit_wait', 0.) + time.time() - tic
+    try:
+        chunks, headers = backend.stream(**kwargs)
+        streamed = StreamedCompletion(chunks, headers, kwargs.get('response_format'))
+        streamed.read_until_action()
+    except RateLimitError as e:
+        if request_limiter is not None:
+            request_limiter.release(e.response.headers, rate_limited=True)
+        raise
+    except BaseException:
+        if request_limiter is not None:
+            request_limiter.release()
+        raise
+    return streamed
+
+
+@retry_transient
+async def aopen_stream(request_tokens=0, stats=None, **kwargs):
+    if stats is not None:
+        stats['attempts'] = stats.get('attempts', 0) + 1
+    if request_limiter is not None:
+        tic = time.time()
+        await request_limiter.aacquire(request_tokens)
+        if stats is not None:
+            stats['limit_wait'] = stats.get('limit_wait', 0.) + time.time() - tic
+    try:
+        chunks, headers = await backend.astream(**kwargs)
+        streamed = StreamedCompletion(chunks, headers, kwargs.get('response_format'))
+        await streamed.aread_until_action()
+    except RateLimitError as e:
+        if request_limiter is not None:
+            request_limiter.release(e.response.headers, rate_limited=True)
+        raise
+    except BaseException:
+        if request_limiter is not None:
+            request_limiter.release()
+        raise
+    return streamed
+
+
+def finish_stream(body, cache_key, streamed, prompt_tokens, stats, tic):
+    ''' Release the limiter, cache the answer of an ended stream and record the answer of an ended or cancelled stream '''
+    if request_limiter is not None:
+        request_limiter.release(streamed.headers)
+    answer = streamed.answer
+    usage = streamed.usage
+    if usage is None:
+        # cancelled, or a server not reporting the usage of streams
+        usage = CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=len(streamed.parser.text) // 4,
+                                total_tokens=prompt_tokens + len(streamed.parser.text) // 4)
+    if stats is not None:
+        stats['stream_time'] = time.time() - tic
+        stats['cutoff'] = not streamed.finished
+
+    # a cut-off answer ends at its action, later runs would take it for the whole completion
+    if streamed.finished:
+        put_cached_response(cache_key, answer, usage)
+    backend.record(body, ChatCompletion(**completion_payload(
+        body, answer, usage.prompt_tokens, usage.completion_tokens, cached_tokens(usage))))
+    return answer, usage
+
+
+def build_messages(system, text, image_list, prefix_text=None, image_labels=None):
+    """
+    Chat messages of a query: the images, each labelled "Image {i}:" unless image_labels[i]
+    is given, then the text. With a prefix_text, it goes ahead of the images (prefix-stable layout).
+    :return: messages and the digests of the images (None for a skipped image)
+    """
     user_content = []
+    if prefix_text is not None:
+        user_content.append(
+            {
+                "type": "text",
+                "text": prefix_text
+            }
+        )
+
+    image_digests = []
     for i, image in enumerate(image_list):
         if image is not None:
             user_content.append(
                 {
                     "type": "text",
-                    "text": f"Image {i}:"
+                    "text": f"Image {i}:" if image_labels is None or image_labels[i] is None else image_labels[i]
                 },
             )
 
-            with open(image, "rb") as image_file:
-                image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
+            image_base64, image_digest = image_encoder.encode(image)
+            image_digests.append(image_digest)
 
             image_message = {
                      "type": "image_url",
@@ -41,6 +245,8 @@ def gpt_infer(system, text, image_list, model="gpt-4-vision-preview", max_tokens
                      }
                  }
             user_content.append(image_message)
+        else:
+            image_digests.append(None)
 
     user_content.append(
         {
@@ -57,16 +263,153 @@ def gpt_infer(system, text, image_list, model="gpt-4-vision-preview", max_tokens
          "content": user_content
          }
     ]
+    return messages, image_digests
+
+
+def cached_tokens(usage):
+    ''' Prompt tokens served from the provider-side prompt cache, 0 if not reported '''
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        return details.get('cached_tokens') or 0
+    return getattr(details, 'cached_tokens', None) or 0
+
+
+def prepare_request(system, text, image_list, model="gpt-4-vision-preview", max_tokens=600, response_format=None,
+                    stats=None, prefix_text=None, image_labels=None):
+    """
+    Body of the chat completion request of a query, and its key in the response cache (None without a cache).
+    See gpt_infer for the arguments.
+    """
+    tic = time.time()
+    messages, image_digests = build_messages(system, text, image_list, prefix_text, image_labels)
 
+    if stats is not None:
+        stats['encode_time'] = time.time() - tic
+        stats['num_images'] = len(image_list) - image_digests.count(None)
+        stats['cached'] = False
+
+    body = dict(model=model, messages=messages, temperature=0, max_tokens=max_tokens)
     if response_format:
-        chat_message = completion_with_backoff(model=model, messages=messages, temperature=0, max_tokens=max_tokens, response_format=response_format)
-    else:
-        chat_message = completion_with_backoff(model=model, messages=messages, temperature=0, max_tokens=max_tokens)
+        body['response_format'] = response_format
+
+    cache_key = None
+    if response_cache is not None:
+        cache_text = text if prefix_text is None else [prefix_text, text]
+        if image_labels is not None:
+            cache_text = [cache_text, image_labels]
+        cache_key = response_cache.make_key(model, system, cache_text, image_digests, max_tokens, response_format)
+    return body, cache_key
+
+
+def get_cached_response(cache_key, stats=None):
+    ''' (answer, usage) of a cached request, or None '''
+    if cache_key is None:
+        return None
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        return None
+    answer, usage = cached
+    if stats is not None:
+        stats['cached'] = True
+    return answer, CompletionUsage(**usage)
+
+
+def put_cached_response(cache_key, answer, usage):
+    if cache_key is not None:
+        response_cache.put(cache_key, answer, usage.model_dump())
+
+
+def request_tokens(system, text, image_list, max_tokens, prefix_text=None):
+    num_images = sum(image is not None for image in image_list)
+    return estimate_tokens(system, (prefix_text or '') + text, num_images, max_tokens)
+
+
+def gpt_infer(system, text, image_list, model="gpt-4-vision-preview", max_tokens=600, response_format=None, stats=None,
+              prefix_text=None, image_labels=None, stream=False, early_cutoff=False):
+    '''
+    stats: optional dict filled with the encode_time and request_time (s), the number of attempts
+    and images, and whether the answer came from the response cache.
+    prefix_text: optional text sent ahead of the images.
+    image_labels: optional labels of the images, e.g. of composites made by GPT/image_budget.py.
+    stream: return as soon as the action is final (GPT/streaming.py). The rest of the completion is
+    cancelled with early_cutoff, else it is read in the background and the tokens are a future of the usage.
+    '''
+    body, cache_key = prepare_request(system, text, image_list, model, max_tokens, response_format,
+                                      stats, prefix_text, image_labels)
+    cached = get_cached_response(cache_key, stats)
+    if cached is not None:
+        return cached
+
+    tic = time.time()
+    if stream:
+        streamed = open_stream(request_tokens(system, text, image_list, max_tokens, prefix_text), stats, **body)
+        if stats is not None:
+            stats['request_time'] = time.time() - tic
+        prompt_tokens = request_tokens(system, text, image_list, 0, prefix_text)
+        if streamed.finished or early_cutoff:
+            if not streamed.finished:
+                streamed.cancel()
+            return finish_stream(body, cache_key, streamed, prompt_tokens, stats, tic)
+
+        def drain():
+            try:
+                streamed.read_to_end()
+            except Exception as e:
+                print('The rest of the completion failed:', e)
+            return finish_stream(body, cache_key, streamed, prompt_tokens, stats, tic)[1]
+        return streamed.parser.answer, drain_in_background(drain)
+
+    chat_message = completion_with_backoff(request_tokens(system, text, image_list, max_tokens, prefix_text),
+                                           stats, **body)
+    if stats is not None:
+        stats['request_time'] = time.time() - tic
 
     # print(chat_message)
     answer = chat_message.choices[0].message.content
     tokens = chat_message.usage
 
+    put_cached_response(cache_key, answer, tokens)
+
     return answer, tokens
 
 
+async def agpt_infer(system, text, image_list, model="gpt-4-vision-preview", max_tokens=600, response_format=None,
+                     stats=None, prefix_text=None, image_labels=None, stream=False, early_cutoff=False):
+    ''' gpt_infer for asyncio, through the async call of the backend '''
+    body, cache_key = prepare_request(system, text, image_list, model, max_tokens, response_format,
+                                      stats, prefix_text, image_labels)
+    cached = get_cached_response(cache_key, stats)
+    if cached is not None:
+        return cached
+
+    tic = time.time()
+    if stream:
+        streamed = await aopen_stream(request_tokens(system, text, image_list, max_tokens, prefix_text),
+                                      stats, **body)
+        if stats is not None:
+            stats['request_time'] = time.time() - tic
+        prompt_tokens = request_tokens(system, text, image_list, 0, prefix_text)
+        if streamed.finished or early_cutoff:
+            if not streamed.finished:
+                await streamed.acancel()
+            return finish_stream(body, cache_key, streamed, prompt_tokens, stats, tic)
+
+        async def drain():
+            try:
+                await streamed.aread_to_end()
+            except Exception as e:
+                print('The rest of the completion failed:', e)
+            return finish_stream(body, cache_key, streamed, prompt_tokens, stats, tic)[1]
+        return streamed.parser.answer, adrain_in_background(drain())
+
+    chat_message = await acompletion_with_backoff(request_tokens(system, text, image_list, max_tokens, prefix_text),
+                                                  stats, **body)
+    if stats is not None:
+        stats['request_time'] = time.time() - tic
+
+    answer = chat_message.choices[0].message.content
+    tokens = chat_message.usage
+
+    put_cached_response(cache_key, answer, tokens)
+
+    return answer, tokens
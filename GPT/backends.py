@@ -0,0 +1,316 @@
+''' LLM backends behind gpt_infer.
+
+    openai  OpenAI or any OpenAI-compatible endpoint (vLLM, llama.cpp server, ...) given by base_url,
+            with a pooled keep-alive HTTP client
+    mock    deterministic in-process answers, for benchmarks without a server
+    replay  answers of a transcript recorded by a previous run (--llm_transcript)
+
+Every backend has a sync (complete) and an async (acomplete) call, and their streamed versions
+(stream, astream) yielding (text delta, usage) with the usage in the last chunk. It reports the capabilities
+of a model (max images per request, JSON mode) and whether it serves the Batch API (GPT/batch.py).
+'''
+import re
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import threading
+import functools
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
+
+
+class Capabilities(object):
+    __slots__ = ('max_images', 'supports_json')
+
+    def __init__(self, max_images=None, supports_json=True):
+        self.max_images = max_images            # None: no limit
+        self.supports_json = supports_json
+
+
+# known limits of the OpenAI models, dated snapshots fall back to the longest matching name
+MODEL_CAPABILITIES = {
+    # GPT-4V only supports string mode output
+    'gpt-4-vision-preview': Capabilities(max_images=None, supports_json=False),
+    # GPT-4o currently does not support queries with more than 20 images
+    'gpt-4o': Capabilities(max_images=20, supports_json=True),
+}
+
+
+def body_key(body):
+    # without the streaming options, so that streamed and complete answers share their transcript
+    body = {k: v for k, v in body.items() if k not in ('stream', 'stream_options')}
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def chunk_usage(chunk):
+    usage = getattr(chunk, 'usage', None)
+    return CompletionUsage(**usage) if isinstance(usage, dict) else usage
+
+
+def iter_chunks(chunks):
+    yield from chunks
+
+
+async def aiter_chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class LLMBackend(object):
+    ''' Base class, the async call runs the sync call in the default executor '''
+
+    supports_batch_api = False
+
+    def __init__(self, transcript=None):
+        self.transcript = transcript
+        self._transcript_lock = threading.Lock()
+
+    def capabilities(self, model):
+        if model in MODEL_CAPABILITIES:
+            return MODEL_CAPABILITIES[model]
+        names = [name for name in MODEL_CAPABILITIES if model.startswith(name)]
+        if len(names) > 0:
+            return MODEL_CAPABILITIES[max(names, key=len)]
+        return Capabilities()
+
+    def _complete(self, **body):
+        ''' :return: ChatCompletion and the response headers '''
+        raise NotImplementedError
+
+    def complete(self, **body):
+        completion, headers = self._complete(**body)
+        self.record(body, completion)
+        return completion, headers
+
+    async def acomplete(self, **body):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.complete, **body))
+
+    def stream(self, **body):
+        '''
+        :return: the chunks and the response headers, closing the chunks cancels the generation.
+        The caller records the streamed answer in the transcript.
+        '''
+        completion, headers = self._complete(**body)
+        return iter_chunks([(completion.choices[0].message.content, completion.usage)]), headers
+
+    async def astream(self, **body):
+        loop = asyncio.get_running_loop()
+        completion, headers = await loop.run_in_executor(None, functools.partial(self._complete, **body))
+        return aiter_chunks([(completion.choices[0].message.content, completion.usage)]), headers
+
+    def record(self, body, completion):
+        ''' Append the request and its answer to the transcript replayed by ReplayBackend '''
+        if self.transcript is None:
+            return
+        line = json.dumps({'key': body_key(body), 'response': completion.model_dump()})
+        with self._transcript_lock:
+            with open(self.transcript, 'a') as f:
+                f.write(line + '\n')
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    ''' OpenAI API, or an OpenAI-compatible server at base_url, through pooled keep-alive connections '''
+
+    def __init__(self, api_key=None, base_url=None, max_connections=64, transcript=None):
+        super().__init__(transcript)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=httpx.Client(limits=self.limits))
+        self.supports_batch_api = hasattr(self.client, 'batches')
+        self.async_client, self.async_loop = None, None
+
+    def _complete(self, **body):
+        # the rate limiter has to see every 429, so the client does not retry on its own
+        response = self.client.with_options(max_retries=0).chat.completions.with_raw_response.create(**body)
+        return response.parse(), response.headers
+
+    def get_async_client(self):
+        # the connections of an async client belong to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        if self.async_loop is not loop:
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                            http_client=httpx.AsyncClient(limits=self.limits))
+            self.async_loop = loop
+        return self.async_client
+
+    async def acomplete(self, **body):
+        response = await self.get_async_client().with_options(max_retries=0).chat.completions.with_raw_response.create(**body)
+        completion = response.parse()
+        self.record(body, completion)
+        return completion, response.headers
+
+    def stream(self, **body):
+        response = self.client.with_options(max_retries=0).chat.completions.with_raw_response.create(
+            stream=True, extra_body={'stream_options': {'include_usage': True}}, **body)
+        return self._chunks(response.parse()), response.headers
+
+    def _chunks(self, stream):
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if len(chunk.choices) > 0 else None
+                yield delta, chunk_usage(chunk)
+        finally:
+            stream.response.close()
+
+    async def astream(self, **body):
+        response = await self.get_async_client().with_options(max_retries=0).chat.completions.with_raw_response.create(
+            stream=True, extra_body={'stream_options': {'include_usage': True}}, **body)
+        return self._achunks(response.parse()), response.headers
+
+    async def _achunks(self, stream):
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if len(chunk.choices) > 0 else None
+                yield delta, chunk_usage(chunk)
+        finally:
+            await stream.response.aclose()
+
+    def close(self):
+        self.client.close()
+
+
+def prompt_parts(body):
+    ''' Texts and ('image', url) of the messages, in order '''
+    parts = []
+    for message in body['messages']:
+        content = message['content']
+        if isinstance(content, str):
+            content = [{'type': 'text', 'text': content}]
+        for c in content:
+            parts.append(c['text'] if c['type'] == 'text' else ('image', c['image_url']['url']))
+    return parts
+
+
+def part_tokens(part):
+    ''' ~4 characters per token, 85 tokens per low-detail image '''
+    return len(part) // 4 if isinstance(part, str) else 85
+
+
+def mock_answer(body):
+    ''' Deterministic action picked from the 'Action options' of the prompt, in the format of response_format '''
+    # the image labels are left out so that the answer does not depend on the prompt layout
+    text = ''
+    for message in body['messages']:
+        content = message['content']
+        if isinstance(content, str):
+            text += content
+        else:
+            text += '\n'.join(c['text'] for c in content
+                              if c['type'] == 'text' and not re.match(r'Image \d+:$', c['text']))
+
+    options = re.findall(r"'([A-Z])\. ", text.split('Action options')[-1])
+    options = options or ['A']
+    action = options[zlib.crc32(text.encode()) % len(options)]
+
+    return format_answer(action, body.get('response_format'), 'Mock thought.', 'Mock planning.')
+
+
+def format_answer(action, response_format=None, thought='', planning=''):
+    ''' Completion choosing the option letter action, in the format parsed by the prompt manager '''
+    if (response_format or {}).get('type') == 'json_object':
+        return json.dumps({"Thought": thought, "New Planning": planning, "Action": action})
+    return f"Thought: {thought}\nDistance: Unknown.\nNew Planning: {planning}\nAction: {action}"
+
+
+def completion_payload(body, answer, prompt_tokens, completion_tokens=None, cached_tokens=0):
+    if completion_tokens is None:
+        completion_tokens = len(answer) // 4
+    return {
+        'id': 'chatcmpl-mock',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body['model'],
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens,
+                  'prompt_tokens_details': {'cached_tokens': cached_tokens}},
+    }
+
+
+class MockBackend(LLMBackend):
+    ''' The answers of scripts/mock_llm_server.py after a fixed latency, without the server '''
+
+    def __init__(self, latency=0., transcript=None):
+        super().__init__(transcript)
+        self.latency = latency
+
+    def _answer(self, body):
+        answer = mock_answer(body)
+        prompt_tokens = sum(part_tokens(part) for part in prompt_parts(body))
+        return ChatCompletion(**completion_payload(body, answer, prompt_tokens)), {}
+
+    def _complete(self, **body):
+        time.sleep(self.latency)
+        return self._answer(body)
+
+    async def acomplete(self, **body):
+        await asyncio.sleep(self.latency)
+        completion, headers = self._answer(body)
+        self.record(body, completion)
+        return completion, headers
+
+    def _pieces(self, body):
+        ''' The answer in chunks of ~1 token, the latency spread over them, the usage with the last one '''
+        completion, _ = self._answer(body)
+        answer = completion.choices[0].message.content
+        pieces = [answer[k: k + 4] for k in range(0, len(answer), 4)]
+        chunks = [(piece, None) for piece in pieces[:-1]] + [(pieces[-1], completion.usage)]
+        return chunks, self.latency / len(chunks)
+
+    def stream(self, **body):
+        chunks, delay = self._pieces(body)
+
+        def generate():
+            for chunk in chunks:
+                time.sleep(delay)
+                yield chunk
+        return generate(), {}
+
+    async def astream(self, **body):
+        chunks, delay = self._pieces(body)
+
+        async def generate():
+            for chunk in chunks:
+                await asyncio.sleep(delay)
+                yield chunk
+        return generate(), {}
+
+
+class ReplayBackend(LLMBackend):
+    ''' Answers recorded in a transcript, a request missing from it is an error '''
+
+    def __init__(self, transcript):
+        super().__init__(None)
+        self.responses = {}
+        with open(transcript) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record['key']] = record['response']
+
+    def _complete(self, **body):
+        key = body_key(body)
+        if key not in self.responses:
+            raise KeyError('request %s is not in the transcript' % key)
+        return ChatCompletion(**self.responses[key]), {}
+
+
+def build_backend(args, api_key=None):
+    if args.llm_backend == 'openai':
+        return OpenAIBackend(api_key=api_key, base_url=args.llm_base_url,
+                             max_connections=args.llm_max_connections, transcript=args.llm_transcript)
+    if args.llm_backend == 'mock':
+        return MockBackend(latency=args.llm_mock_latency, transcript=args.llm_transcript)
+    if args.llm_backend == 'replay':
+        return ReplayBackend(args.llm_transcript)
+    raise NotImplementedError(args.llm_backend)
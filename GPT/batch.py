@@ -0,0 +1,130 @@
+''' Backends running a JSONL file of chat completion requests in the Batch API format:
+
+    {"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+and returning the output lines {"custom_id": ..., "response": {"status_code": ..., "body": {...}}, "error": ...}.
+'''
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from GPT import api
+
+
+# the Batch API accepts input files of up to 200 MB
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+
+
+def write_batch_files(requests, path_prefix, max_bytes=MAX_BATCH_FILE_BYTES):
+    """
+    :param requests: [(custom_id, body)]
+    :return: paths of the input files, <path_prefix>_<k>.jsonl, each under max_bytes
+    """
+    paths, f, size = [], None, 0
+    for custom_id, body in requests:
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) + '\n'
+        if f is None or (size > 0 and size + len(line) > max_bytes):
+            if f is not None:
+                f.close()
+            paths.append('%s_%d.jsonl' % (path_prefix, len(paths)))
+            f, size = open(paths[-1], 'w'), 0
+        f.write(line)
+        size += len(line)
+    if f is not None:
+        f.close()
+    return paths
+
+
+def read_batch_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LocalBatchBackend(object):
+    """
+    File-based stand-in of the Batch API: every request of the input file is sent to the chat
+    completions endpoint of the configured backend (e.g. scripts/mock_llm_server.py), concurrency at a time,
+    and the responses are written next to it as <input>_output.jsonl.
+    """
+
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+
+    def _complete(self, request, request_tokens=0):
+        try:
+            chat_message = api.completion_with_backoff(request_tokens, **request['body'])
+            response, error = {"status_code": 200, "body": chat_message.model_dump()}, None
+        except Exception as e:
+            response, error = None, {"message": str(e)}
+        return {"id": "batch_req_local", "custom_id": request['custom_id'], "response": response, "error": error}
+
+    def run(self, paths, request_tokens=None):
+        ''' request_tokens: optional estimate of the tokens of each custom_id, charged to the TPM limit '''
+        request_tokens = request_tokens or {}
+        results = []
+        for path in paths:
+            with open(path) as f:
+                requests = [json.loads(line) for line in f if line.strip()]
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                outputs = list(executor.map(
+                    lambda request: self._complete(request, request_tokens.get(request['custom_id'], 0)), requests
+                ))
+
+            output_path = path[:-len('.jsonl')] + '_output.jsonl'
+            with open(output_path, 'w') as f:
+                for output in outputs:
+                    f.write(json.dumps(output) + '\n')
+            results.extend(read_batch_output(output_path))
+        return results
+
+
+class OpenAIBatchBackend(object):
+    ''' The OpenAI Batch API: upload the files, create the batches and poll them until they end '''
+
+    def __init__(self, poll_interval=30, completion_window='24h'):
+        if not api.backend.supports_batch_api:
+            import openai
+            raise RuntimeError('The Batch API requires the openai backend and openai>=1.16, found %s with %s' % (
+                openai.__version__, type(api.backend).__name__))
+        self.client = api.backend.client
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def run(self, paths, request_tokens=None):
+        # the Batch API has its own queue limits, request_tokens is for the client-side limiter
+        batch_ids = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose='batch')
+            batch = self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                              completion_window=self.completion_window)
+            print('Submitted %s as batch %s' % (path, batch.id))
+            batch_ids.append(batch.id)
+
+        results = []
+        for path, batch_id in zip(paths, batch_ids):
+            batch = self.client.batches.retrieve(batch_id)
+            while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+                time.sleep(self.poll_interval)
+                batch = self.client.batches.retrieve(batch_id)
+            if batch.output_file_id is None and batch.error_file_id is None:
+                raise RuntimeError('Batch %s of %s ended as %s' % (batch_id, path, batch.status))
+
+            # requests that failed are in the error file, the caller resubmits them
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id is None:
+                    continue
+                output_path = path[:-len('.jsonl')] + '_%s.jsonl' % file_id
+                with open(output_path, 'w') as f:
+                    f.write(self.client.files.content(file_id).text)
+                results.extend(read_batch_output(output_path))
+        return results
+
+
+def build_batch_backend(args):
+    if args.llm_batch == 'local':
+        return LocalBatchBackend(concurrency=args.llm_concurrency or args.parallel_episodes)
+    if args.llm_batch == 'openai':
+        return OpenAIBatchBackend(poll_interval=args.batch_poll_interval)
+    raise NotImplementedError(args.llm_batch)
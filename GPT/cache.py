@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResponseCache(object):
+    """
+    Persistent cache of LLM responses in a SQLite file, keyed by a hash of the request.
+
+    Modes:
+        readwrite: read-through and write-through, misses are queried and stored
+        readonly:  read-through only, misses are queried but never stored
+        replay:    answers only from the cache, a miss raises KeyError
+        record:    always queries and stores (overwriting) the response
+    """
+    modes = ('readwrite', 'readonly', 'replay', 'record')
+
+    def __init__(self, path, mode='readwrite', max_size_mb=None):
+        assert mode in self.modes, 'unknown cache mode %s' % mode
+        self.path = path
+        self.mode = mode
+        self.max_size = None if max_size_mb is None else int(max_size_mb * 1024 * 1024)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, answer TEXT, usage TEXT, size INTEGER, last_access REAL)"
+        )
+        self._conn.commit()
+        self._total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, system, text, image_digests, max_tokens, response_format):
+        request = json.dumps([model, system, text, image_digests, max_tokens, response_format], sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ Returns (answer, usage dict) or None. Always None in record mode. """
+        if self.mode == 'record':
+            return None
+
+        with self._lock:
+            row = self._conn.execute("SELECT answer, usage FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == 'replay':
+                    raise KeyError('request %s is not in the response cache %s' % (key, self.path))
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access=? WHERE key=?", (time.time(), key))
+            self._conn.commit()
+        return row[0], json.loads(row[1])
+
+    def put(self, key, answer, usage):
+        if self.mode not in ('readwrite', 'record'):
+            return
+
+        usage = json.dumps(usage)
+        size = len(key) + len(answer) + len(usage)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            if old is not None:
+                self._total_size -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, answer, usage, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, answer, usage, size, time.time())
+            )
+            self._total_size += size
+            self.writes += 1
+            if self.max_size is not None and self._total_size > self.max_size:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # drop the least recently used entries until 90% of the size budget is left
+        target = int(self.max_size * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if self._total_size <= target:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key=?", (key,))
+            self._total_size -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'size_mb': self._total_size / 1024 / 1024,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,64 @@
+import math
+
+from GPT.rate_limiter import LOW_DETAIL_IMAGE_TOKENS
+
+
+class ImageBudget(object):
+    """
+    Chooses the images sent with a request, at most max_images of them and image_token_budget
+    tokens. The images over the budget are dropped ('drop'), or the least important ones are
+    tiled tile_size per composite image ('tile'). Dropped images are set to None, so the other
+    images keep their "Image {i}" labels. The candidates come first, but they are tiled or
+    dropped too if there are more of them than the limit.
+    """
+
+    def __init__(self, max_images=20, image_token_budget=None, policy='drop', tile_size=4):
+        limit = max_images
+        if image_token_budget is not None:
+            limit = min(limit, image_token_budget // LOW_DETAIL_IMAGE_TOKENS)
+        self.limit = max(limit, 1)
+        self.policy = policy
+        self.tile_size = tile_size
+
+    def select(self, image_list, keep, order):
+        """
+        :param keep: indices that are always sent (the current candidates)
+        :param order: the other indices, from the most to the least important
+        :return: the images to send and their labels (None to label them "Image {i}:")
+        """
+        keep = [k for k in keep if image_list[k] is not None]
+        kept = set(keep)
+        order = [k for k in order if image_list[k] is not None and k not in kept]
+        if len(keep) + len(order) <= self.limit:
+            return image_list, None
+        if len(keep) > self.limit:
+            # the candidates compete for the slots, ahead of the other images
+            if self.policy != 'tile':
+                print('%d candidate images over the limit of %d images, dropping %d of them' % (
+                    len(keep), self.limit, len(keep) - self.limit))
+            keep, order = [], keep + order
+
+        slots = max(self.limit - len(keep), 0)
+        single, tiles = order[:slots], []
+        if self.policy == 'tile':
+            # trade single images for composites until everything else fits
+            num_single = slots
+            while num_single > 0 and num_single + math.ceil((len(order) - num_single) / self.tile_size) > slots:
+                num_single -= 1
+            single = order[:num_single]
+            rest = order[num_single:]
+            tiles = [rest[k: k + self.tile_size] for k in range(0, len(rest), self.tile_size)]
+            tiles = tiles[:slots - num_single]
+
+        images = [None] * len(image_list)
+        for k in keep + single:
+            images[k] = image_list[k]
+        labels = [None] * len(image_list)
+        for tile in tiles:
+            tile = sorted(tile)
+            if len(tile) == 1:
+                images[tile[0]] = image_list[tile[0]]
+                continue
+            images[tile[0]] = tuple(image_list[k] for k in tile)
+            labels[tile[0]] = 'Images %s (left to right, top to bottom):' % ', '.join(str(k) for k in tile)
+        return images, (labels if len(tiles) > 0 else None)
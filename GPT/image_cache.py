@@ -0,0 +1,196 @@
+''' Cache of base64 encoded observation images.
+
+Images are encoded once per process through an LRU keyed by (path, mtime), or served from a
+packed store built offline from img_root. A tuple of paths is encoded as one composite image.
+
+    python -m GPT.image_cache --img_root /path/to/images --output /path/to/images.pack [--downscale]
+'''
+import io
+import os
+import math
+import mmap
+import base64
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# "low" detail images are processed at 512x512 on the provider side
+LOW_DETAIL_SIZE = 512
+
+
+class ImageStore(object):
+    """
+    Pre-encoded images packed in one file. <path> holds the concatenated base64 payloads,
+    <path>.npz the keys ("<scan>/<viewpoint>/<ix>.jpg"), offsets, lengths, digests, the mtimes of
+    the source images and whether they were downscaled. An image modified since it was packed is
+    not served from the store.
+    """
+
+    def __init__(self, path, img_root):
+        self.path = path
+        self.img_root = os.path.abspath(img_root)
+        index = np.load(path + '.npz')
+        if 'mtimes' not in index:
+            raise ValueError('%s was packed without the mtimes of its images, pack it again' % path)
+        self.keys = {key: i for i, key in enumerate(index['keys'].tolist())}
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.digests = index['digests']
+        self.mtimes = index['mtimes']
+        self.downscale = bool(index['downscale'])
+        self.stale = 0
+
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, image):
+        """ Returns (base64, digest) of an image path, or None if it is not in the store or changed since. """
+        key = os.path.relpath(os.path.abspath(image), self.img_root)
+        i = self.keys.get(key)
+        if i is None:
+            return None
+        try:
+            mtime = os.stat(image).st_mtime_ns
+        except FileNotFoundError:
+            # only kept in the store
+            mtime = self.mtimes[i]
+        if mtime != self.mtimes[i]:
+            if self.stale == 0:
+                print('%s changed since it was packed in %s, encoding the stale images from their files' % (
+                    image, self.path))
+            self.stale += 1
+            return None
+        offset, length = int(self.offsets[i]), int(self.lengths[i])
+        return self._data[offset: offset + length].decode('ascii'), self.digests[i].decode('ascii')
+
+
+class ImageEncoder(object):
+    '''
+    LRU cache of base64 encoded images keyed by path and mtime, backed by an optional ImageStore.
+    downscale: resize single images to the "low" detail resolution, as a store packed with --downscale.
+    '''
+
+    def __init__(self, max_size=4096, store=None, downscale=False):
+        if store is not None and store.downscale != downscale:
+            raise ValueError('%s was packed %s --downscale, the images would differ from the ones encoded from files' % (
+                store.path, 'with' if store.downscale else 'without'))
+        self.max_size = max_size
+        self.store = store
+        self.downscale = downscale
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, image):
+        """ Returns (base64, sha1 digest of the image content). image is a path or a tuple of paths to tile. """
+        tiled = isinstance(image, tuple)
+        if self.store is not None and not tiled:
+            item = self.store.get(image)
+            if item is not None:
+                return item
+
+        if tiled:
+            key = tuple((path, os.stat(path).st_mtime_ns) for path in image)
+        else:
+            key = (image, os.stat(image).st_mtime_ns)
+        with self._lock:
+            item = self._cache.get(key)
+            if item is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return item
+
+        if tiled:
+            image_bytes = tile_images([_read(path) for path in image])
+        else:
+            image_bytes = _read(image)
+            if self.downscale:
+                image_bytes = downscale_image(image_bytes)
+        item = (base64.b64encode(image_bytes).decode('utf-8'), hashlib.sha1(image_bytes).hexdigest())
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = item
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return item
+
+
+def _read(path):
+    with open(path, "rb") as image_file:
+        return image_file.read()
+
+
+def tile_images(images_bytes, size=LOW_DETAIL_SIZE):
+    """ One size x size JPEG with the images on a grid, left to right and top to bottom """
+    from PIL import Image
+
+    cols = int(math.ceil(math.sqrt(len(images_bytes))))
+    rows = int(math.ceil(len(images_bytes) / cols))
+    cell = size // cols
+    composite = Image.new('RGB', (cell * cols, cell * rows))
+    for k, image_bytes in enumerate(images_bytes):
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        image.thumbnail((cell, cell))
+        row, col = divmod(k, cols)
+        composite.paste(image, (col * cell + (cell - image.width) // 2, row * cell + (cell - image.height) // 2))
+    output = io.BytesIO()
+    composite.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def downscale_image(image_bytes, size=LOW_DETAIL_SIZE):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes))
+    image.thumbnail((size, size))
+    output = io.BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def pack_images(img_root, output, downscale=False):
+    keys, offsets, lengths, digests, mtimes = [], [], [], [], []
+    offset = 0
+    with open(output, 'wb') as f:
+        for scan in sorted(os.listdir(img_root)):
+            scan_dir = os.path.join(img_root, scan)
+            if not os.path.isdir(scan_dir):
+                continue
+            for viewpoint in sorted(os.listdir(scan_dir)):
+                for name in sorted(os.listdir(os.path.join(scan_dir, viewpoint))):
+                    if not name.endswith('.jpg'):
+                        continue
+                    image_path = os.path.join(scan_dir, viewpoint, name)
+                    mtimes.append(os.stat(image_path).st_mtime_ns)
+                    image_bytes = _read(image_path)
+                    if downscale:
+                        image_bytes = downscale_image(image_bytes)
+                    payload = base64.b64encode(image_bytes)
+                    f.write(payload)
+
+                    keys.append('%s/%s/%s' % (scan, viewpoint, name))
+                    offsets.append(offset)
+                    lengths.append(len(payload))
+                    digests.append(hashlib.sha1(image_bytes).hexdigest())
+                    offset += len(payload)
+
+    np.savez(output + '.npz', keys=np.array(keys), offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int64), digests=np.array(digests, dtype='S40'),
+             mtimes=np.array(mtimes, dtype=np.int64), downscale=downscale)
+    print('Packed %d images (%.1f MB) into %s' % (len(keys), offset / 1024 / 1024, output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--img_root', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--downscale', action='store_true', default=False,
+                        help='resize to the "low" detail resolution before encoding (requires Pillow)')
+    args = parser.parse_args()
+    pack_images(args.img_root, args.output, downscale=args.downscale)
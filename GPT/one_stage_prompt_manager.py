@@ -6,12 +6,78 @@ class OneStagePromptManager(object):
     def __init__(self, args):
 
         self.args = args
-        self.history  = ['' for _ in range(self.args.batch_size)]
-        self.nodes_list = [[] for _ in range(self.args.batch_size)]
-        self.node_imgs = [[] for _ in range(self.args.batch_size)]
-        self.graph  = [{} for _ in range(self.args.batch_size)]
-        self.trajectory = [[] for _ in range(self.args.batch_size)]
-        self.planning = [["Navigation has just started, with no planning yet."] for _ in range(self.args.batch_size)]
+        self.task_descriptions = {}
+        self.reset()
+
+    def reset(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.args.batch_size
+        self.history  = ['' for _ in range(batch_size)]
+        self.nodes_list = [[] for _ in range(batch_size)]
+        self.node_imgs = [[] for _ in range(batch_size)]
+        self.graph  = [{} for _ in range(batch_size)]
+        self.trajectory = [[] for _ in range(batch_size)]
+        self.planning = [["Navigation has just started, with no planning yet."] for _ in range(batch_size)]
+        self._reset_map_cache(batch_size)
+
+    def _reset_map_cache(self, batch_size):
+        # map texts extended as places are observed and visited, see make_map_prompt
+        self.node_index = [{} for _ in range(batch_size)]
+        self.unvisited = [{} for _ in range(batch_size)]    # {viewpoint: supplementary info line}, by place ID
+        self.trajectory_text = ['Place' for _ in range(batch_size)]
+        self.graph_text = ['' for _ in range(batch_size)]
+
+    def _rebuild_map_cache(self):
+        batch_size = len(self.nodes_list)
+        self._reset_map_cache(batch_size)
+        for i in range(batch_size):
+            for node_index, node in enumerate(self.nodes_list[i]):
+                self.node_index[i][node] = node_index
+                if node not in self.graph[i]:
+                    self.unvisited[i][node] = self._supp_line(node_index)
+            visited = set()
+            for node in self.trajectory[i]:
+                self.trajectory_text[i] += f""" {self.node_index[i][node]}"""
+                if node not in visited:
+                    visited.add(node)
+                    self.graph_text[i] += self._graph_line(i, node)
+
+    def _supp_line(self, node_index):
+        return f"""\nPlace {node_index}, which is corresponding to Image {node_index}"""
+
+    def _graph_line(self, i, node):
+        node_index = self.node_index[i]
+        adj_text = ''
+        for adj_node in self.graph[i][node]:
+            adj_text += f""" {node_index[adj_node]},"""
+        return f"""\nPlace {node_index[node]} is connected with Places{adj_text}"""[:-1]
+
+    def _add_node(self, i, viewpoint, image):
+        node_index = len(self.nodes_list[i])
+        self.nodes_list[i].append(viewpoint)
+        self.node_imgs[i].append(image)
+        self.node_index[i][viewpoint] = node_index
+        self.unvisited[i][viewpoint] = self._supp_line(node_index)
+        return node_index
+
+    def state_dict(self):
+        return {
+            'history': self.history,
+            'nodes_list': self.nodes_list,
+            'node_imgs': self.node_imgs,
+            'graph': self.graph,
+            'trajectory': self.trajectory,
+            'planning': self.planning,
+        }
+
+    def load_state_dict(self, state):
+        self.history = state['history']
+        self.nodes_list = state['nodes_list']
+        self.node_imgs = state['node_imgs']
+        self.graph = state['graph']
+        self.trajectory = state['trajectory']
+        self.planning = state['planning']
+        self._rebuild_map_cache()
 
     def get_action_concept(self, rel_heading, rel_elevation):
         if rel_elevation > 0:
@@ -40,7 +106,7 @@ class OneStagePromptManager(object):
 
     def make_action_prompt(self, obs, previous_angle):
 
-        nodes_list, graph, trajectory, node_imgs = self.nodes_list, self.graph, self.trajectory, self.node_imgs
+        graph, trajectory, node_imgs = self.graph, self.trajectory, self.node_imgs
 
         batch_view_lens, batch_cand_vpids = [], []
         batch_cand_index = []
@@ -51,31 +117,33 @@ class OneStagePromptManager(object):
             cand_index = []
             action_prompts = []
 
-            if ob['viewpoint'] not in nodes_list[i]:
+            node_index = self.node_index[i]
+
+            if ob['viewpoint'] not in node_index:
                 # update nodes list (place 0)
-                nodes_list[i].append(ob['viewpoint'])
-                node_imgs[i].append(None)
+                self._add_node(i, ob['viewpoint'], None)
 
             # update trajectory
             trajectory[i].append(ob['viewpoint'])
+            self.trajectory_text[i] += f""" {node_index[ob['viewpoint']]}"""
 
-            # cand views
+            # cand views, Candidate records of vln/candidates.py
             for j, cc in enumerate(ob['candidate']):
 
-                cand_vpids.append(cc['viewpointId'])
-                cand_index.append(cc['pointId'])
-                direction = self.get_action_concept(cc['absolute_heading'] - previous_angle[i]['heading'],
-                                                          cc['absolute_elevation'] - 0)
+                cand_vpids.append(cc.viewpointId)
+                cand_index.append(cc.pointId)
+                direction = self.get_action_concept(cc.absolute_heading - previous_angle[i]['heading'],
+                                                          cc.absolute_elevation - 0)
 
-                if cc['viewpointId'] not in nodes_list[i]:
-                    nodes_list[i].append(cc['viewpointId'])
-                    node_imgs[i].append(cc['image'])
-                    node_index = nodes_list[i].index(cc['viewpointId'])
+                if cc.viewpointId not in node_index:
+                    cand_node_index = self._add_node(i, cc.viewpointId, cc.image)
                 else:
-                    node_index = nodes_list[i].index(cc['viewpointId'])
-                    node_imgs[i][node_index] = cc['image']
+                    cand_node_index = node_index[cc.viewpointId]
+                    # the prefix-stable layout keeps the first image of a place so that earlier images do not change
+                    if self.args.prompt_layout != 'prefix_stable' or node_imgs[i][cand_node_index] is None:
+                        node_imgs[i][cand_node_index] = cc.image
 
-                action_text = direction + f" to Place {node_index} which is corresponding to Image {node_index}"
+                action_text = direction + f" to Place {cand_node_index} which is corresponding to Image {cand_node_index}"
                 action_prompts.append(action_text)
 
             batch_cand_index.append(cand_index)
@@ -85,6 +153,9 @@ class OneStagePromptManager(object):
             # update graph
             if ob['viewpoint'] not in graph[i].keys():
                 graph[i][ob['viewpoint']] = cand_vpids
+                # first visit of the place
+                self.graph_text[i] += self._graph_line(i, ob['viewpoint'])
+                self.unvisited[i].pop(ob['viewpoint'], None)
 
         return {
             'cand_vpids': batch_cand_vpids,
@@ -122,49 +193,26 @@ class OneStagePromptManager(object):
                 self.history[i] += f""", step {str(t)}: {last_action}"""
 
     def make_map_prompt(self, i):
-        # graph-related text
-        trajectory = self.trajectory[i]
-        nodes_list = self.nodes_list[i]
+        """
+        Graph-related text. The trajectory and connectivity texts are extended by make_action_prompt,
+        so only the supplementary info, which depends on the current candidates, is assembled here.
+        """
         graph = self.graph[i]
-
-        no_dup_nodes = []
-        trajectory_text = 'Place'
-        graph_text = ''
-
-        candidate_nodes = graph[trajectory[-1]]
-
-        # trajectory and map connectivity
-        for node in trajectory:
-            node_index = nodes_list.index(node)
-            trajectory_text += f""" {node_index}"""
-
-            if node not in no_dup_nodes:
-                no_dup_nodes.append(node)
-
-                adj_text = ''
-                adjacent_nodes = graph[node]
-                for adj_node in adjacent_nodes:
-                    adj_index = nodes_list.index(adj_node)
-                    adj_text += f""" {adj_index},"""
-
-                graph_text += f"""\nPlace {node_index} is connected with Places{adj_text}"""[:-1]
+        candidate_nodes = set(graph[self.trajectory[i][-1]])
 
         # ghost nodes info
-        graph_supp_text = ''
-        supp_exist = None
-        for node_index, node in enumerate(nodes_list):
-
-            if node in trajectory or node in candidate_nodes:
-                continue
-            supp_exist = True
-            graph_supp_text += f"""\nPlace {node_index}, which is corresponding to Image {node_index}"""
-
-        if supp_exist is None:
+        graph_supp_text = ''.join(
+            line for node, line in self.unvisited[i].items() if node not in candidate_nodes
+        )
+        if graph_supp_text == '':
             graph_supp_text = """Nothing yet."""
 
-        return trajectory_text, graph_text, graph_supp_text
+        return self.trajectory_text[i], self.graph_text[i], graph_supp_text
 
-    def make_r2r_prompts(self, obs, cand_inputs, t):
+    def make_task_description(self, response_format):
+        """ The system prompt, identical at every step and cached """
+        if response_format in self.task_descriptions:
+            return self.task_descriptions[response_format]
 
         background = """You are an embodied robot that navigates in the real world."""
         background_supp = """You need to explore between some places marked with IDs and ultimately find the destination to stop.""" \
@@ -180,19 +228,30 @@ class OneStagePromptManager(object):
 
         requirement = """For each provided image of the places, you should combine the 'Instruction' and carefully examine the relevant information, such as scene descriptions, landmarks, and objects. You need to align 'Instruction' with 'History' (including corresponding images) to estimate your instruction execution progress and refer to 'Map' for path planning. Check the Place IDs in the 'History' and 'Trajectory', avoiding repeated exploration that leads to getting stuck in a loop, unless it is necessary to backtrack to a specific place."""
         dist_require = """If you can already see the destination, estimate the distance between you and it. If the distance is far, continue moving and try to stop within 1 meter of the destination."""
-        thought = """Your answer must include four parts: 'Thought', 'Distance', 'New Planning', and 'Action'. You need to combine 'Instruction', 'Trajectory', 'Map', 'Supplementary Info', your past 'History', 'Previous Planning', 'Action options', and the provided images to think about what to do next and why, and complete your thinking into 'Thought'."""
+        if response_format == 'str':
+            thought = """Your answer must include four parts: 'Thought', 'Distance', 'New Planning', and 'Action'. You need to combine 'Instruction', 'Trajectory', 'Map', 'Supplementary Info', your past 'History', 'Previous Planning', 'Action options', and the provided images to think about what to do next and why, and complete your thinking into 'Thought'."""
+        else:
+            thought = """Your answer should be JSON format and must include three fields: 'Thought', 'New Planning', and 'Action'. You need to combine 'Instruction', 'Trajectory', 'Map', 'Supplementary Info', your past 'History', 'Previous Planning', 'Action options', and the provided images to think about what to do next and why, and complete your thinking into 'Thought'."""
         new_planning = """Based on your 'Map', 'Previous Planning' and current 'Thought', you also need to update your new multi-step path planning to 'New Planning'."""
         action = """At the end of your output, you must provide a single capital letter in the 'Action options' that corresponds to the action you have decided to take, and place only the letter into 'Action', such as "Action: A"."""
 
         task_description = f"""{background} {background_supp}\n{instr_des}\n{history}\n{traj_info}\n{map_info}\n{map_supp}\n{pre_planning}\n{option}\n{requirement}\n{dist_require}\n{thought}\n{new_planning}\n{action}"""
+        self.task_descriptions[response_format] = task_description
+        return task_description
+
+    def make_r2r_prompts(self, obs, cand_inputs, t):
+
+        task_description = self.make_task_description('str')
 
         init_history = 'The navigation has just begun, with no history.'
 
         batch_size = len(obs)
         action_options_batch, only_options_batch = self.make_action_options(cand_inputs, t=t)
         prompt_batch = []
+        prefix_batch = []
         for i in range(batch_size):
             instruction = obs[i]["instruction"]
+            prefix_batch.append(f"""Instruction: {instruction}""")
 
             trajectory_text, graph_text, graph_supp_text = self.make_map_prompt(i)
 
@@ -206,6 +265,7 @@ class OneStagePromptManager(object):
         nav_input = {
             "task_description": task_description,
             "prompts" : prompt_batch,
+            "prompt_prefixes": prefix_batch,    # the instruction line the prompts start with
             "only_options": only_options_batch,
             "action_options": action_options_batch,
             "only_actions": cand_inputs["action_prompts"]
@@ -215,33 +275,17 @@ class OneStagePromptManager(object):
 
     def make_r2r_json_prompts(self, obs, cand_inputs, t):
 
-        background = """You are an embodied robot that navigates in the real world."""
-        background_supp = """You need to explore between some places marked with IDs and ultimately find the destination to stop.""" \
-        + """ At each step, a series of images corresponding to the places you have explored and have observed will be provided to you."""
-
-        instr_des = """'Instruction' is a global, step-by-step detailed guidance, but you might have already executed some of the commands. You need to carefully discern the commands that have not been executed yet."""
-        traj_info = """'Trajectory' represents the ID info of the places you have explored. You start navigating from Place 0."""
-        map_info = """'Map' refers to the connectivity between the places you have explored and other places you have observed."""
-        map_supp = """'Supplementary Info' records some places and their corresponding images you have ever seen but have not yet visited. These places are only considered when there is a navigation error, and you decide to backtrack for further exploration."""
-        history = """'History' represents the places you have explored in previous steps along with their corresponding images. It may include the correct landmarks mentioned in the 'Instruction' as well as some past erroneous explorations."""
-        option = """'Action options' are some actions that you can take at this step."""
-        pre_planning = """'Previous Planning' records previous long-term multi-step planning info that you can refer to now."""
-
-        requirement = """For each provided image of the places, you should combine the 'Instruction' and carefully examine the relevant information, such as scene descriptions, landmarks, and objects. You need to align 'Instruction' with 'History' (including corresponding images) to estimate your instruction execution progress and refer to 'Map' for path planning. Check the Place IDs in the 'History' and 'Trajectory', avoiding repeated exploration that leads to getting stuck in a loop, unless it is necessary to backtrack to a specific place."""
-        dist_require = """If you can already see the destination, estimate the distance between you and it. If the distance is far, continue moving and try to stop within 1 meter of the destination."""
-        thought = """Your answer should be JSON format and must include three fields: 'Thought', 'New Planning', and 'Action'. You need to combine 'Instruction', 'Trajectory', 'Map', 'Supplementary Info', your past 'History', 'Previous Planning', 'Action options', and the provided images to think about what to do next and why, and complete your thinking into 'Thought'."""
-        new_planning = """Based on your 'Map', 'Previous Planning' and current 'Thought', you also need to update your new multi-step path planning to 'New Planning'."""
-        action = """At the end of your output, you must provide a single capital letter in the 'Action options' that corresponds to the action you have decided to take, and place only the letter into 'Action', such as "Action: A"."""
-
-        task_description = f"""{background} {background_supp}\n{instr_des}\n{history}\n{traj_info}\n{map_info}\n{map_supp}\n{pre_planning}\n{option}\n{requirement}\n{dist_require}\n{thought}\n{new_planning}\n{action}"""
+        task_description = self.make_task_description('json')
 
         init_history = 'The navigation has just begun, with no history.'
 
         batch_size = len(obs)
         action_options_batch, only_options_batch = self.make_action_options(cand_inputs, t=t)
         prompt_batch = []
+        prefix_batch = []
         for i in range(batch_size):
             instruction = obs[i]["instruction"]
+            prefix_batch.append(f"""Instruction: {instruction}""")
 
             trajectory_text, graph_text, graph_supp_text = self.make_map_prompt(i)
 
@@ -255,6 +299,7 @@ class OneStagePromptManager(object):
         nav_input = {
             "task_description": task_description,
             "prompts" : prompt_batch,
+            "prompt_prefixes": prefix_batch,    # the instruction line the prompts start with
             "only_options": only_options_batch,
             "action_options": action_options_batch,
             "only_actions": cand_inputs["action_prompts"]
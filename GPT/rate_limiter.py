@@ -0,0 +1,131 @@
+import re
+import time
+import asyncio
+import multiprocessing
+
+
+# tokens of an image sent with detail 'low'
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+
+def estimate_tokens(system, text, num_images, max_tokens):
+    """ Upper bound of the tokens a request counts against the TPM limit, ~4 characters per token """
+    return (len(system) + len(text)) // 4 + num_images * LOW_DETAIL_IMAGE_TOKENS + max_tokens
+
+
+def parse_reset(value):
+    """ '1s', '6m0s', '20ms' -> seconds """
+    seconds = 0.
+    for number, unit in re.findall(r'([\d.]+)(ms|s|m|h)', value or ''):
+        seconds += float(number) * {'ms': 1e-3, 's': 1., 'm': 60., 'h': 3600.}[unit]
+    return seconds
+
+
+class RateLimiter(object):
+    """
+    Client-side limit of the OpenAI requests, shared by every thread and, when created before
+    the worker processes with their multiprocessing context, by every process.
+
+    Requests and tokens per minute are two token buckets refilled continuously. The number of
+    requests in flight follows AIMD: it grows by one every window of successful requests and is
+    halved on a 429, which also pauses everyone until the reset announced by the server.
+    The x-ratelimit-remaining-* headers lower the local buckets when the server sees less budget.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, max_rpm=None, max_tpm=None, max_concurrency=None, ctx=multiprocessing):
+        self.max_rpm = max_rpm
+        self.max_tpm = max_tpm
+        self.max_concurrency = max_concurrency
+
+        self._lock = ctx.Lock()
+        self._requests = ctx.Value('d', max_rpm or 0., lock=False)
+        self._tokens = ctx.Value('d', max_tpm or 0., lock=False)
+        self._last_refill = ctx.Value('d', time.time(), lock=False)
+        self._paused_until = ctx.Value('d', 0., lock=False)
+        self._in_flight = ctx.Value('i', 0, lock=False)
+        self._concurrency = ctx.Value('d', max_concurrency or 0., lock=False)
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill.value
+        self._last_refill.value = now
+        if self.max_rpm:
+            self._requests.value = min(self.max_rpm, self._requests.value + elapsed * self.max_rpm / 60.)
+        if self.max_tpm:
+            self._tokens.value = min(self.max_tpm, self._tokens.value + elapsed * self.max_tpm / 60.)
+
+    def _try_acquire(self, tokens):
+        """ Take the budget of one request, or return the seconds to wait before trying again """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+
+            wait = self._paused_until.value - now
+            if self.max_concurrency and self._in_flight.value >= int(self._concurrency.value):
+                wait = max(wait, self.poll_interval)
+            if self.max_rpm and self._requests.value < 1:
+                wait = max(wait, (1 - self._requests.value) * 60. / self.max_rpm)
+            if self.max_tpm:
+                # a request larger than the whole bucket waits for a full bucket
+                tokens = min(tokens, self.max_tpm)
+                if self._tokens.value < tokens:
+                    wait = max(wait, (tokens - self._tokens.value) * 60. / self.max_tpm)
+            if wait > 0:
+                return wait
+
+            self._requests.value -= 1
+            self._tokens.value -= tokens
+            self._in_flight.value += 1
+            return 0
+
+    def acquire(self, tokens=0):
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, headers=None, rate_limited=False):
+        """ Finish a request with the response headers; rate_limited if it was answered with a 429 """
+        headers = headers or {}
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self._in_flight.value -= 1
+
+            if self.max_concurrency:
+                if rate_limited:
+                    self._concurrency.value = max(1., self._concurrency.value / 2)
+                else:
+                    self._concurrency.value = min(
+                        self.max_concurrency, self._concurrency.value + 1. / self._concurrency.value
+                    )
+
+            remaining = headers.get('x-ratelimit-remaining-requests')
+            if remaining is not None and self.max_rpm:
+                self._requests.value = min(self._requests.value, float(remaining))
+            remaining = headers.get('x-ratelimit-remaining-tokens')
+            if remaining is not None and self.max_tpm:
+                self._tokens.value = min(self._tokens.value, float(remaining))
+
+            if rate_limited:
+                pause = headers.get('retry-after')
+                if pause is not None:
+                    pause = float(pause)
+                else:
+                    pause = max(parse_reset(headers.get('x-ratelimit-reset-requests')),
+                                parse_reset(headers.get('x-ratelimit-reset-tokens')), 1.)
+                self._paused_until.value = max(self._paused_until.value, now + pause)
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self._in_flight.value, 'concurrency': int(self._concurrency.value),
+                    'requests': self._requests.value, 'tokens': self._tokens.value}
@@ -0,0 +1,183 @@
+''' Streamed completions: the action is committed as soon as it is final.
+
+ActionStreamParser reads the completion chunk by chunk. Once the action is final, the answer
+received so far already holds what the agent parses (New Planning, then Action), so the agent
+can move while the rest of the completion is generated: it is drained in the background, or
+cancelled with early cutoff.
+'''
+import re
+import json
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+# the letter is final once the character after it arrives
+STR_ACTION = re.compile(r"Action:\s*([A-M])(?=[^A-Za-z])")
+JSON_STRING = r'"(?:[^"\\]|\\.)*"'
+JSON_ACTION = re.compile(r'"Action"\s*:\s*(%s|-?\d+(?=\s*[,}]))' % JSON_STRING)
+JSON_PLANNING = re.compile(r'"New Planning"\s*:\s*%s' % JSON_STRING)
+
+
+class ActionStreamParser(object):
+    """
+    Incremental parser of the Action and New Planning fields, in the str or JSON format.
+    answer is None until the action is final, then the shortest answer parsed like the full one:
+    the text up to the action letter (str), or up to the last of the two fields, closed with '}' (JSON).
+    """
+
+    def __init__(self, response_format=None):
+        self.json_mode = (response_format or {}).get('type') == 'json_object'
+        self.text = ''
+        self.answer = None
+        self._searched = 0      # the str action starts after this offset
+
+    def feed(self, delta):
+        if delta:
+            self.text += delta
+            if self.answer is None:
+                self.answer = self._json_answer() if self.json_mode else self._str_answer()
+        return self.answer
+
+    def _str_answer(self):
+        match = STR_ACTION.search(self.text, self._searched)
+        if match is None:
+            # resume from the last keyword, which may still be arriving
+            last = self.text.rfind('Action', self._searched)
+            self._searched = last if last >= 0 else max(len(self.text) - len('Action'), 0)
+            return None
+        return self.text[:match.end(1)]
+
+    def _json_answer(self):
+        action = JSON_ACTION.search(self.text)
+        planning = JSON_PLANNING.search(self.text)
+        if action is None or planning is None:
+            return None
+        answer = self.text[:max(action.end(), planning.end())].rstrip() + '}'
+        try:
+            json.loads(answer)
+        except ValueError:
+            return None
+        return answer
+
+
+class StreamedCompletion(object):
+    ''' The chunks of a streamed completion read through an ActionStreamParser '''
+
+    def __init__(self, chunks, headers, response_format=None):
+        self.chunks = chunks
+        self.headers = headers
+        self.parser = ActionStreamParser(response_format)
+        self.usage = None
+        self.finished = False
+
+    def _read(self, delta, usage):
+        self.parser.feed(delta)
+        if usage is not None:
+            self.usage = usage
+        return self.parser.answer is not None
+
+    def read_until_action(self):
+        for delta, usage in self.chunks:
+            if self._read(delta, usage):
+                return
+        self.finished = True
+
+    def read_to_end(self):
+        for delta, usage in self.chunks:
+            self._read(delta, usage)
+        self.finished = True
+
+    def cancel(self):
+        self.chunks.close()
+
+    async def aread_until_action(self):
+        async for delta, usage in self.chunks:
+            if self._read(delta, usage):
+                return
+        self.finished = True
+
+    async def aread_to_end(self):
+        async for delta, usage in self.chunks:
+            self._read(delta, usage)
+        self.finished = True
+
+    async def acancel(self):
+        await self.chunks.aclose()
+
+    @property
+    def answer(self):
+        ''' The whole completion once it ended, else the answer up to the action '''
+        if self.finished or self.parser.answer is None:
+            return self.parser.text
+        return self.parser.answer
+
+
+# completions still generating after their action was committed, until close() ends the run
+drain_executor = None
+pending = set()
+
+
+def drain_in_background(fn):
+    ''' Run fn in a thread, its future is done once the completion ended '''
+    global drain_executor
+    if drain_executor is None:
+        drain_executor = ThreadPoolExecutor(max_workers=16)
+    future = drain_executor.submit(fn)
+    pending.add(future)
+    future.add_done_callback(pending.discard)
+    return future
+
+
+def adrain_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    pending.add(task)
+    task.add_done_callback(pending.discard)
+    return task
+
+
+def then(future, fn):
+    '''
+    Call fn with the result of future once it is done. Unlike a bare done callback, fn is pending
+    until it returns, so that wait_pending / await_pending also wait for it.
+    '''
+    done = asyncio.get_running_loop().create_future() if isinstance(future, asyncio.Future) else Future()
+    pending.add(done)
+    done.add_done_callback(pending.discard)
+
+    def callback(f):
+        try:
+            fn(f.result())
+            done.set_result(None)
+        except Exception as e:
+            print('Callback of a pending completion failed:', e)
+            done.set_exception(e)
+    future.add_done_callback(callback)
+    return done
+
+
+def wait_pending():
+    # a callback may add pending futures while we wait
+    while True:
+        futures = [f for f in pending if not isinstance(f, asyncio.Future)]
+        if len(futures) == 0:
+            return
+        wait(futures)
+
+
+async def await_pending():
+    while True:
+        tasks = [f for f in pending if isinstance(f, asyncio.Future)]
+        if len(tasks) == 0:
+            return
+        await asyncio.wait(tasks)
+
+
+def close():
+    ''' Wait for the completions still generating and stop the drain threads, at the end of a run '''
+    global drain_executor
+    wait_pending()
+    if drain_executor is not None:
+        drain_executor.shutdown()
+        drain_executor = None
+    # tasks of an event loop that is already closed
+    pending.clear()
@@ -0,0 +1,173 @@
+''' Micro-benchmark of the candidate and observation records built at every step.
+
+    python scripts/candidate_records.py --viewpoints 2000 --steps 200000
+
+Replays random walks on synthetic sweep rows, each path walked by 3 instructions as in R2R, and
+compares the former dict records (copied on every cache hit) with the shared read-only records of
+R2RNavBatch.make_candidate, reading the fields the prompt manager and the agent read.
+'''
+import os
+import sys
+import math
+import time
+import random
+import argparse
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vln.env import R2RNavBatch, Observation
+
+
+def dict_make_candidate(self, scanId, viewpointId, viewId):
+    ''' make_candidate with dict records, as before the Candidate records '''
+    base_heading = (viewId % 12) * math.radians(30)
+    base_elevation = (viewId // 12 - 1) * math.radians(30)
+
+    long_id = "%s_%s" % (scanId, viewpointId)
+
+    if long_id not in self.buffered_state_dict:
+        candidate = []
+        for (cand_vp, ix, idx, abs_heading, abs_elevation, rel_heading, rel_elevation, position) in \
+                self.get_candidate_rows(scanId, viewpointId):
+            candidate.append({
+                'heading': abs_heading - base_heading + rel_heading,
+                'elevation': abs_elevation - base_elevation + rel_elevation,
+                "normalized_heading": abs_heading + rel_heading,
+                "normalized_elevation": abs_elevation + rel_elevation,
+                'scanId': scanId,
+                'viewpointId': cand_vp,
+                'pointId': ix,
+                'distance': np.sqrt(rel_heading ** 2 + rel_elevation ** 2),
+                'idx': idx,
+                'position': position,
+                'caption': None,
+                'image': os.path.join(self.args.img_root, scanId, viewpointId, str(ix) + '.jpg'),
+                'absolute_heading': abs_heading,
+                'absolute_elevation': abs_elevation,
+                'pretrained_inference': None,
+            })
+        self.buffered_state_dict[long_id] = [
+            {key: c[key] for key in c if key not in ('heading', 'elevation')} for c in candidate
+        ]
+        return candidate
+
+    candidate_new = []
+    for c in self.buffered_state_dict[long_id]:
+        c_new = c.copy()
+        c_new['heading'] = c_new['normalized_heading'] - base_heading
+        c_new['elevation'] = c_new['normalized_elevation'] - base_elevation
+        c_new.pop('normalized_heading')
+        c_new.pop('normalized_elevation')
+        candidate_new.append(c_new)
+    return candidate_new
+
+
+def dict_observation(item, state, candidate, distance):
+    return {
+        'instr_id': item['instr_id'],
+        'scan': state.scanId,
+        'viewpoint': state.location.viewpointId,
+        'viewIndex': state.viewIndex,
+        'position': (state.location.x, state.location.y, state.location.z),
+        'heading': state.heading,
+        'elevation': state.elevation,
+        'candidate': candidate,
+        'navigableLocations': state.navigableLocations,
+        'instruction': item['instruction'],
+        'instr_encoding': item.get('instr_encoding'),
+        'gt_path': item['path'],
+        'path_id': item['path_id'],
+        'surrounding_tags': None,
+        'distance': distance,
+    }
+
+
+class Env(object):
+    def __init__(self, rows, make_candidate):
+        self.args = SimpleNamespace(img_root='../datasets/RGB_Observations')
+        self.rows = rows
+        self.buffered_state_dict = {}
+        self.buffered_views = {}
+        self.make_candidate = make_candidate.__get__(self)
+
+    def get_candidate_rows(self, scanId, viewpointId):
+        return self.rows[viewpointId]
+
+
+def make_rows(num_viewpoints, rng):
+    viewpoints = ['%032x' % rng.getrandbits(128) for _ in range(num_viewpoints)]
+    rows = {}
+    for vp in viewpoints:
+        rows[vp] = [(rng.choice(viewpoints), rng.randrange(36), j + 1, rng.uniform(0, 2 * math.pi),
+                     rng.uniform(-0.5, 0.5), rng.uniform(-0.3, 0.3), rng.uniform(-0.3, 0.3),
+                     (rng.uniform(0, 10), rng.uniform(0, 10), rng.uniform(0, 3)))
+                    for j in range(rng.randint(2, 8))]
+    return viewpoints, rows
+
+
+def make_steps(viewpoints, rows, num_steps, rng, path_len=6, instructions_per_path=3):
+    ''' (viewpoint, view) of random walks: a move to a candidate arrives at the view where it was seen '''
+    steps = []
+    while len(steps) < num_steps:
+        path = [(rng.choice(viewpoints), rng.randrange(36))]
+        for _ in range(path_len - 1):
+            cand_vp, ix = rng.choice(rows[path[-1][0]])[:2]
+            path.append((cand_vp, ix))
+        steps.extend(path * instructions_per_path)
+    return steps[:num_steps]
+
+
+def read_dict(ob):
+    for cc in ob['candidate']:
+        cc['viewpointId'], cc['pointId'], cc['absolute_heading'], cc['absolute_elevation'], cc['image']
+    return ob['candidate'][0]['idx']
+
+
+def read_record(ob):
+    for cc in ob['candidate']:
+        cc.viewpointId, cc.pointId, cc.absolute_heading, cc.absolute_elevation, cc.image
+    return ob['candidate'][0]['idx']
+
+
+def run(env, make_observation, read, steps):
+    item = {'instr_id': '0_0', 'instruction': 'Walk ahead.', 'path': [], 'path_id': 0}
+    # simulator states, not part of the measure
+    states = {}
+    for vp, view in steps:
+        location = SimpleNamespace(viewpointId=vp, x=0., y=0., z=0.)
+        states[vp, view] = SimpleNamespace(scanId='scan', location=location, viewIndex=view, heading=0.,
+                                           elevation=0., navigableLocations=[location])
+
+    tic = time.time()
+    for vp, view in steps:
+        candidate = env.make_candidate('scan', vp, view)
+        state = states[vp, view]
+        # the fields read by the prompt manager and the agent
+        read(make_observation(item, state, candidate, 0))
+    return time.time() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--viewpoints', type=int, default=2000)
+    parser.add_argument('--steps', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    viewpoints, rows = make_rows(args.viewpoints, rng)
+    steps = make_steps(viewpoints, rows, args.steps, rng)
+
+    dict_time = run(Env(rows, dict_make_candidate), dict_observation, read_dict, steps)
+    record_time = run(Env(rows, R2RNavBatch.make_candidate), Observation, read_record, steps)
+    print('%d steps on %d viewpoints' % (args.steps, args.viewpoints))
+    print('dict records:    %.2fs (%.2fus per step)' % (dict_time, 1e6 * dict_time / args.steps))
+    print('slotted records: %.2fs (%.2fus per step), %.1fx' % (
+        record_time, 1e6 * record_time / args.steps, dict_time / record_time))
+
+
+if __name__ == '__main__':
+    main()
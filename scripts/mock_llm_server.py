@@ -0,0 +1,150 @@
+''' A local OpenAI-compatible chat-completions server for testing the pipeline without API costs.
+
+    python scripts/mock_llm_server.py --port 8000 --latency 2.0
+    OPENAI_BASE_URL=http://localhost:8000/v1 bash scripts/gpt4o.sh
+
+It answers every request after a fixed latency with the deterministic answers of the mock backend
+(GPT/backends.py): an action picked from the 'Action options' of the prompt, in the str or JSON format
+depending on response_format.
+Streamed requests are answered with server-sent chunks. With --rpm it also enforces a requests-per-minute limit with 429s and x-ratelimit-* headers.
+Prompt tokens are estimated (4 characters or one low-detail image = 85 tokens), and the
+prefix shared with recent requests is reported as usage.prompt_tokens_details.cached_tokens,
+like the provider-side prompt caching.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GPT.backends import mock_answer, completion_payload, prompt_parts, part_tokens
+
+
+def common_prefix_tokens(parts, other):
+    tokens = 0
+    for a, b in zip(parts, other):
+        if a == b:
+            tokens += part_tokens(a)
+            continue
+        if isinstance(a, str) and isinstance(b, str):
+            n = 0
+            while n < min(len(a), len(b)) and a[n] == b[n]:
+                n += 1
+            tokens += n // 4
+        break
+    return tokens
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.
+    rpm = None
+    requests = deque()
+    lock = threading.Lock()
+    recent_prompts = deque(maxlen=256)
+
+    def count_prompt_tokens(self, body):
+        ''' :return: prompt tokens, and those cached: a prefix of 1024+ tokens in 128-token blocks '''
+        parts = prompt_parts(body)
+        with self.lock:
+            cached = max([common_prefix_tokens(parts, other) for other in self.recent_prompts], default=0)
+            self.recent_prompts.append(parts)
+        cached = cached // 128 * 128 if cached >= 1024 else 0
+        return sum(part_tokens(part) for part in parts), cached
+
+    def check_rate_limit(self):
+        ''' :return: (accepted, x-ratelimit-* headers) over a sliding window of one minute '''
+        with self.lock:
+            now = time.time()
+            while self.requests and self.requests[0] <= now - 60:
+                self.requests.popleft()
+            accepted = len(self.requests) < self.rpm
+            if accepted:
+                self.requests.append(now)
+            reset = self.requests[0] + 60 - now if self.requests else 0.
+            return accepted, {
+                'x-ratelimit-limit-requests': str(self.rpm),
+                'x-ratelimit-remaining-requests': str(self.rpm - len(self.requests)),
+                'x-ratelimit-reset-requests': '%.3fs' % reset,
+            }
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        headers = {}
+        if self.rpm is not None:
+            accepted, headers = self.check_rate_limit()
+            if not accepted:
+                self.send_json(429, {'error': {'message': 'Rate limit reached for requests', 'type': 'requests',
+                                               'code': 'rate_limit_exceeded'}}, headers)
+                return
+
+        answer = mock_answer(body)
+        prompt_tokens, cached_tokens = self.count_prompt_tokens(body)
+        payload = completion_payload(body, answer, prompt_tokens, cached_tokens=cached_tokens)
+        if body.get('stream'):
+            self.send_stream(body, payload, headers)
+            return
+        time.sleep(self.latency)
+        self.send_json(200, payload, headers)
+
+    def send_stream(self, body, payload, headers):
+        ''' Server-sent chunks of ~1 token, the latency spread over them '''
+        answer = payload['choices'][0]['message']['content']
+        pieces = [answer[k: k + 4] for k in range(0, len(answer), 4)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        chunk = {key: payload[key] for key in ('id', 'created', 'model')}
+        chunk['object'] = 'chat.completion.chunk'
+        events = [dict(chunk, choices=[{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}])
+                  for piece in pieces]
+        events.append(dict(chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if (body.get('stream_options') or {}).get('include_usage'):
+            events.append(dict(chunk, choices=[], usage=payload['usage']))
+        try:
+            for event in events:
+                time.sleep(self.latency / len(events))
+                self.wfile.write(b'data: ' + json.dumps(event).encode() + b'\n\n')
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the generation
+            pass
+
+    def send_json(self, code, body, headers):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0., help='seconds to wait before answering')
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute before answering 429')
+    args = parser.parse_args()
+
+    Handler.latency = args.latency
+    Handler.rpm = args.rpm
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print('Mock LLM server listening on http://127.0.0.1:%d/v1' % args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+''' Prefix overlap of consecutive LLM requests for each prompt layout, without calling the API.
+
+    python scripts/prefix_overlap.py --root_dir ../datasets --img_root ../datasets/RGB_Observations \
+        --split MapGPT_72_scenes_processed --llm gpt-4o-2024-05-13 --response_format json --episodes 20
+
+Episodes are driven by the deterministic answers of the mock backend, and every request is compared
+with the previous request of its episode: the shared prefix is what provider-side prompt caching
+can reuse. Tokens are estimated as in scripts/mock_llm_server.py.
+'''
+import io
+import os
+import sys
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_llm_server import common_prefix_tokens
+from vln.parser import parse_args
+from vln.main_gpt import build_dataset
+from vln.gpt_agent import GPTNavAgent
+from GPT.api import build_messages
+from GPT.backends import mock_answer, prompt_parts, part_tokens
+
+
+def measure_layout(args, env, num_episodes):
+    agent = GPTNavAgent(args, env)
+    env.reset_epoch(shuffle=False)
+
+    steps, total, shared, cacheable = 0, 0, 0, 0
+    for _ in range(min(num_episodes, len(env.data))):
+        obs = env.reset()
+        traj = agent.init_traj(obs)
+        navigation = agent.navigate(agent.prompt_manager, obs, traj)
+        previous = None
+        try:
+            request = next(navigation)
+            while True:
+                messages, _ = build_messages(request['system'], request['text'], request['image_list'],
+                                             request.get('prefix_text'), request.get('image_labels'))
+                body = {'messages': messages, 'response_format': request.get('response_format')}
+                parts = prompt_parts(body)
+                if previous is not None:
+                    prefix = common_prefix_tokens(parts, previous)
+                    steps += 1
+                    total += sum(part_tokens(part) for part in parts)
+                    shared += prefix
+                    cacheable += prefix // 128 * 128 if prefix >= 1024 else 0
+                previous = parts
+                request = navigation.send((mock_answer(body), None))
+        except StopIteration:
+            pass
+
+    return steps, total, shared, cacheable
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--episodes', type=int, default=20)
+    parser.add_argument('--layouts', type=str, nargs='+', default=['default', 'prefix_stable'])
+    bench_args, _ = parser.parse_known_args()
+
+    args = parse_args()
+    env = list(build_dataset(args).values())[0]
+
+    for layout in bench_args.layouts:
+        args.prompt_layout = layout
+        with contextlib.redirect_stdout(io.StringIO()):
+            steps, total, shared, cacheable = measure_layout(args, env, bench_args.episodes)
+        print('%-14s %d steps after the first, prompt tokens: %d, shared prefix: %d (%.1f%%), cacheable: %d (%.1f%%)' % (
+            layout, steps, total, shared, 100. * shared / max(total, 1), cacheable, 100. * cacheable / max(total, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+''' Binary navigation graphs: each <scan>_connectivity.json converted once to CSR arrays.
+
+    python -m utils.connectivity --connectivity_dir ../datasets/R2R/connectivity
+
+The npz of a scan holds the table of its included viewpoints, their positions (V, 3), and the
+undirected edges as CSR adjacency: the neighbours of viewpoint i are indices[indptr[i]: indptr[i+1]]
+(int32), at the euclidean distances weights[indptr[i]: indptr[i+1]] (float32).
+'''
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+class ScanConnectivity(object):
+    ''' Navigation graph of one scan, with a networkx view built on first access '''
+
+    def __init__(self, viewpoints, positions, indptr, indices, weights):
+        self.viewpoints = list(viewpoints)
+        self.index = {vp: i for i, vp in enumerate(self.viewpoints)}
+        self.positions = positions      # (V, 3) float64
+        self.indptr = indptr            # (V + 1,) int32
+        self.indices = indices          # (E,) int32, both directions of every edge
+        self.weights = weights          # (E,) float32
+        self._graph = None
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        included = np.array([item['included'] for item in data], dtype=bool)
+        keep = np.nonzero(included)[0]
+        if len(keep) == 0:
+            return cls([], np.zeros((0, 3)), np.zeros(1, dtype=np.int32),
+                       np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+
+        unobstructed = np.array([data[i]['unobstructed'] for i in keep], dtype=bool)[:, keep]
+        assert (unobstructed == unobstructed.T).all(), 'Graph should be undirected'
+        np.fill_diagonal(unobstructed, False)
+        positions = np.array([data[i]['pose'] for i in keep], dtype=np.float64)[:, [3, 7, 11]]
+
+        rows, cols = np.nonzero(unobstructed)
+        indptr = np.zeros(len(keep) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=len(keep)), out=indptr[1:])
+        connectivity = cls([data[i]['image_id'] for i in keep], positions, indptr,
+                           cols.astype(np.int32), np.zeros(len(cols), dtype=np.float32))
+        connectivity.weights = connectivity.edge_lengths().astype(np.float32)
+        return connectivity
+
+    def save(self, path, **extra):
+        np.savez(path, viewpoints=np.array(self.viewpoints), positions=self.positions,
+                 indptr=self.indptr, indices=self.indices, weights=self.weights, **extra)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['viewpoints'].tolist(), data['positions'], data['indptr'],
+                       data['indices'], data['weights'])
+
+    def __len__(self):
+        return len(self.viewpoints)
+
+    def neighbors(self, vp):
+        i = self.index[vp]
+        return [self.viewpoints[j] for j in self.indices[self.indptr[i]: self.indptr[i + 1]]]
+
+    def edge_rows(self):
+        ''' Source viewpoint index of each entry of indices '''
+        return np.repeat(np.arange(len(self.viewpoints)), np.diff(self.indptr))
+
+    def edge_lengths(self):
+        ''' float64 euclidean length of each entry of indices, as computed from the JSON poses '''
+        delta = self.positions[self.edge_rows()] - self.positions[self.indices]
+        return np.sqrt(delta[:, 0] ** 2 + delta[:, 1] ** 2 + delta[:, 2] ** 2)
+
+    def node_order(self):
+        ''' The viewpoints with an edge, in the order the networkx graph adds them '''
+        sequence = np.stack([self.edge_rows(), self.indices], axis=1).ravel()
+        _, first = np.unique(sequence, return_index=True)
+        return sequence[np.sort(first)]
+
+    def position_dict(self):
+        return dict(zip(self.viewpoints, map(tuple, self.positions.tolist())))
+
+    @property
+    def graph(self):
+        ''' networkx.Graph of the viewpoints with an edge, with 'weight' edges and 'position' nodes '''
+        if self._graph is None:
+            import networkx as nx
+
+            G = nx.Graph()
+            vps = self.viewpoints
+            G.add_weighted_edges_from(zip([vps[i] for i in self.edge_rows()], [vps[j] for j in self.indices],
+                                          self.weights.tolist()))
+            nx.set_node_attributes(G, values={vp: self.positions[self.index[vp]] for vp in G}, name='position')
+            self._graph = G
+        return self._graph
+
+
+def load_connectivity(connectivity_dir, scan, cache_dir=None):
+    """
+    Navigation graph of a scan, converted once and cached as <cache_dir>/<scan>_connectivity.npz.
+    The cache is rebuilt when the connectivity file is modified.
+    """
+    source = os.path.join(connectivity_dir, '%s_connectivity.json' % scan)
+    if cache_dir is None:
+        return ScanConnectivity.from_json(source)
+    source_mtime = os.path.getmtime(source)
+
+    cache_file = os.path.join(cache_dir, '%s_connectivity.npz' % scan)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            fresh = float(data['source_mtime']) == source_mtime
+        if fresh:
+            return ScanConnectivity.load(cache_file)
+
+    connectivity = ScanConnectivity.from_json(source)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '%s.%d.tmp.npz' % (cache_file[:-len('.npz')], os.getpid())
+        connectivity.save(tmp_file, source_mtime=source_mtime)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print('Cannot cache the connectivity of %s: %s' % (scan, e))
+    return connectivity
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--connectivity_dir', type=str, default='../datasets/R2R/connectivity')
+    parser.add_argument('--output_dir', type=str, default=None, help='default: <connectivity_dir>_cache')
+    parser.add_argument('--scans', type=str, nargs='*', default=None)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.normpath(args.connectivity_dir) + '_cache'
+    scans = args.scans
+    if not scans:
+        scans = sorted(name[:-len('_connectivity.json')] for name in os.listdir(args.connectivity_dir)
+                       if name.endswith('_connectivity.json'))
+
+    for scan in scans:
+        connectivity = load_connectivity(args.connectivity_dir, scan, output_dir)
+        print('%s: %d viewpoints, %d edges' % (scan, len(connectivity), len(connectivity.indices) // 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,38 +4,16 @@ import json
 import random
 
 import h5py
-import networkx as nx
 import math
 import numpy as np
 
+from utils.connectivity import load_connectivity
 
 
-def load_nav_graphs(connectivity_dir, scans):
-    ''' Load connectivity graph for each scan '''
-
-    def distance(pose1, pose2):
-        ''' Euclidean distance between two graph poses '''
-        return ((pose1['pose'][3]-pose2['pose'][3])**2\
-          + (pose1['pose'][7]-pose2['pose'][7])**2\
-          + (pose1['pose'][11]-pose2['pose'][11])**2)**0.5
-
-    graphs = {}
-    for scan in scans:
-        with open(os.path.join(connectivity_dir, '%s_connectivity.json' % scan)) as f:
-            G = nx.Graph()
-            positions = {}
-            data = json.load(f)
-            for i,item in enumerate(data):
-                if item['included']:
-                    for j,conn in enumerate(item['unobstructed']):
-                        if conn and data[j]['included']:
-                            positions[item['image_id']] = np.array([item['pose'][3],
-                                    item['pose'][7], item['pose'][11]]);
-                            assert data[j]['unobstructed'][i], 'Graph should be undirected'
-                            G.add_edge(item['image_id'],data[j]['image_id'],weight=distance(item,data[j]))
-            nx.set_node_attributes(G, values=positions, name='position')
-            graphs[scan] = G
-    return graphs
+
+def load_nav_graphs(connectivity_dir, scans, cache_dir=None):
+    ''' Load connectivity graph for each scan, as the networkx views of utils/connectivity.py '''
+    return {scan: load_connectivity(connectivity_dir, scan, cache_dir).graph for scan in scans}
 
 def new_simulator(connectivity_dir, scan_data_dir=None):
     import MatterSim
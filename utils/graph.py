@@ -0,0 +1,218 @@
+''' Compact all-pairs shortest paths of the navigation graphs '''
+import os
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.connectivity import load_connectivity
+
+
+# bumped when the cached shortest paths change, e.g. 2: equal paths broken as networkx
+CACHE_VERSION = 2
+
+
+def dijkstra_all_pairs(adjacency):
+    """
+    All-pairs shortest paths by a Dijkstra search from every node, as nx.all_pairs_dijkstra_path:
+    the neighbours are visited in the order of adjacency, and a path is only replaced by a strictly
+    shorter one, so that equally short paths are broken the same way as networkx.
+    :param adjacency: adjacency[i] is the list of (j, weight) of node i, in the order of G.adj[i]
+    :return: float64 distance matrix (np.inf if unreachable) and predecessor matrix, where
+             predecessors[i, j] is the node before j on the shortest path from i to j (-1 if none).
+    """
+    num_nodes = len(adjacency)
+    distances = np.full((num_nodes, num_nodes), np.inf)
+    predecessors = np.full((num_nodes, num_nodes), -1, dtype=np.int32)
+
+    for source in range(num_nodes):
+        dist, seen, pred = {}, {source: 0}, {source: source}
+        counter = itertools.count()
+        fringe = [(0, next(counter), source)]
+        while fringe:
+            dist_v, _, v = heapq.heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = dist_v
+            for u, cost in adjacency[v]:
+                vu_dist = dist_v + cost
+                if u not in dist and (u not in seen or vu_dist < seen[u]):
+                    seen[u] = vu_dist
+                    pred[u] = v
+                    heapq.heappush(fringe, (vu_dist, next(counter), u))
+
+        nodes = list(dist.keys())
+        distances[source, nodes] = list(dist.values())
+        predecessors[source, nodes] = [pred[u] for u in nodes]
+
+    return distances, predecessors
+
+
+class ScanShortestPaths(object):
+    ''' Shortest distances and paths between the viewpoints of one scan, stored as dense matrices. '''
+
+    def __init__(self, viewpoints, distances, predecessors):
+        self.viewpoints = list(viewpoints)
+        self.index = {vp: i for i, vp in enumerate(self.viewpoints)}
+        self.distances = distances          # (V, V) float32
+        self.predecessors = predecessors    # (V, V) int16 / int32
+
+    @classmethod
+    def from_graph(cls, G):
+        viewpoints = list(G.nodes)
+        index = {vp: i for i, vp in enumerate(viewpoints)}
+        adjacency = [[(index[v], data['weight']) for v, data in G.adj[u].items()] for u in viewpoints]
+
+        distances, predecessors = dijkstra_all_pairs(adjacency)
+        pred_dtype = np.int16 if len(viewpoints) < np.iinfo(np.int16).max else np.int32
+        return cls(viewpoints, distances.astype(np.float32), predecessors.astype(pred_dtype))
+
+    @classmethod
+    def from_connectivity(cls, connectivity):
+        ''' From the CSR arrays of a ScanConnectivity, with the viewpoints in the order of from_graph '''
+        order = connectivity.node_order()
+        relabel = np.full(len(connectivity), -1, dtype=np.int64)
+        relabel[order] = np.arange(len(order))
+        # the CSR neighbours are in the order of the networkx graph, ascending in the JSON file.
+        # float64 lengths, the float32 weights would break near ties differently
+        lengths = connectivity.edge_lengths().tolist()
+        neighbors = relabel[connectivity.indices].tolist()
+        adjacency = [
+            list(zip(neighbors[connectivity.indptr[k]: connectivity.indptr[k + 1]],
+                     lengths[connectivity.indptr[k]: connectivity.indptr[k + 1]]))
+            for k in order
+        ]
+        distances, predecessors = dijkstra_all_pairs(adjacency)
+        pred_dtype = np.int16 if len(order) < np.iinfo(np.int16).max else np.int32
+        viewpoints = [connectivity.viewpoints[k] for k in order]
+        return cls(viewpoints, distances.astype(np.float32), predecessors.astype(pred_dtype))
+
+    def distance(self, u, v):
+        return float(self.distances[self.index[u], self.index[v]])
+
+    def path(self, u, v):
+        i, j = self.index[u], self.index[v]
+        if self.predecessors[i, j] < 0:
+            raise KeyError('%s is not reachable from %s' % (v, u))
+        path = [j]
+        while j != i:
+            j = int(self.predecessors[i, j])
+            path.append(j)
+        return [self.viewpoints[k] for k in reversed(path)]
+
+    def save(self, path, **extra):
+        np.savez(path, viewpoints=np.array(self.viewpoints), distances=self.distances,
+                 predecessors=self.predecessors, **extra)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['viewpoints'].tolist(), data['distances'], data['predecessors'])
+
+
+class _Row(object):
+    __slots__ = ('lookup', 'u')
+
+    def __init__(self, lookup, u):
+        self.lookup = lookup
+        self.u = u
+
+    def __getitem__(self, v):
+        return self.lookup(self.u, v)
+
+
+class DistanceTable(object):
+    ''' Read-only view with the {view_id_x: {view_id_y: distance}} interface of the nested dicts '''
+
+    def __init__(self, shortest_paths):
+        self.shortest_paths = shortest_paths
+
+    def __getitem__(self, u):
+        return _Row(self.shortest_paths.distance, u)
+
+    def __contains__(self, u):
+        return u in self.shortest_paths.index
+
+
+class PathTable(DistanceTable):
+    ''' Read-only view with the {view_id_x: {view_id_y: [path]}} interface of the nested dicts '''
+
+    def __getitem__(self, u):
+        return _Row(self.shortest_paths.path, u)
+
+
+def load_shortest_paths(connectivity_dir, scan, cache_dir=None):
+    """
+    Shortest paths of a scan, computed once and cached as <cache_dir>/<scan>_shortest_paths.npz.
+    The cache is rebuilt when the connectivity file is modified or CACHE_VERSION changes.
+    """
+    source = os.path.join(connectivity_dir, '%s_connectivity.json' % scan)
+    source_mtime = os.path.getmtime(source)
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, '%s_shortest_paths.npz' % scan)
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as data:
+                fresh = float(data['source_mtime']) == source_mtime and \
+                    'version' in data and int(data['version']) == CACHE_VERSION
+            if fresh:
+                return ScanShortestPaths.load(cache_file)
+
+    shortest_paths = ScanShortestPaths.from_connectivity(load_connectivity(connectivity_dir, scan, cache_dir))
+
+    if cache_file is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = '%s.%d.tmp.npz' % (cache_file[:-len('.npz')], os.getpid())
+            shortest_paths.save(tmp_file, source_mtime=source_mtime, version=CACHE_VERSION)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print('Cannot cache the shortest paths of %s: %s' % (scan, e))
+
+    return shortest_paths
+
+
+class LazyScanDict(object):
+    ''' {scan_id: value} loaded on first access by load_fn, keeping at most max_size scans (LRU) '''
+
+    def __init__(self, load_fn, max_size=None):
+        self.load_fn = load_fn
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, scan):
+        with self._lock:
+            if scan in self._data:
+                self._data.move_to_end(scan)
+                return self._data[scan]
+
+            value = self.load_fn(scan)
+            self._data[scan] = value
+            if self.max_size is not None:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+            return value
+
+    def __contains__(self, scan):
+        return scan in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+
+class ScanViews(object):
+    ''' {scan_id: view_class(scan_paths[scan_id])}, the views are cheap and not cached '''
+
+    def __init__(self, scan_paths, view_class):
+        self.scan_paths = scan_paths
+        self.view_class = view_class
+
+    def __getitem__(self, scan):
+        return self.view_class(self.scan_paths[scan])
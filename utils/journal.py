@@ -0,0 +1,63 @@
+import os
+import json
+
+
+class ResultJournal(object):
+    ''' Append-only JSONL file of finished cases, fsync-ed every fsync_every records '''
+
+    def __init__(self, path, fsync_every=1):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.records = self._load()
+        self._pending = 0
+        self._file = open(path, 'a')
+
+    def _load(self):
+        records = []
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # a crash may leave a partial last line behind
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            if line.strip():
+                records.append(json.loads(line))
+        return records
+
+    def append(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        self._pending += 1
+        if self._pending >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        self._file.flush()
+        self.sync()
+        self._file.close()
+
+
+def save_checkpoint(path, state):
+    ''' Atomically replace the json file at path '''
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
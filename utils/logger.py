@@ -1,9 +1,13 @@
 import os
 import sys
+import json
 import math
 import time
+import threading
 from collections import OrderedDict
 
+import numpy as np
+
 
 def write_to_record_file(data, file_path, verbose=True):
     if verbose:
@@ -57,6 +61,67 @@ class Timer:
         print(total / self.iter)
 
 
+# per-step timings recorded by the rollout, in seconds
+STEP_TIMINGS = ['step_time', 'prompt_time', 'encode_time', 'request_time', 'stream_time', 'limit_wait', 'parse_time',
+                'sim_time']
+STEP_COUNTS = ['prompt_tokens', 'cached_tokens', 'completion_tokens', 'num_images', 'attempts', 'cached', 'cutoff', 'cost']
+
+
+def load_step_records(file_path):
+    records = []
+    if os.path.exists(file_path):
+        with open(file_path) as f:
+            for line in f:
+                if line.endswith('\n'):     # skip a partial last line
+                    records.append(json.loads(line))
+    return records
+
+
+class StepRecorder(object):
+    ''' Appends one JSON record per navigation step, shared by the threads of the rollout '''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.records = load_step_records(file_path)
+        self.num_loaded = len(self.records)     # recorded by previous runs
+        self._lock = threading.Lock()
+        self._file = open(file_path, 'a')
+
+    def record(self, **fields):
+        line = json.dumps(fields)
+        with self._lock:
+            self.records.append(fields)
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def summarize_steps(records):
+    """ p50/p95/p99 of the step timings and totals of the tokens, requests and cost """
+    summary = OrderedDict(steps=len(records))
+    for key in STEP_TIMINGS:
+        values = [r[key] for r in records if r.get(key) is not None]
+        if len(values) > 0:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[key] = OrderedDict(total=float(np.sum(values)), p50=p50, p95=p95, p99=p99)
+    for key in STEP_COUNTS:
+        summary[key] = sum(r.get(key) or 0 for r in records)
+    return summary
+
+
+def format_step_summary(summary):
+    lines = ["Steps (%d)  -  prompt_tokens: %d (cached %d)  completion_tokens: %d  images: %d  requests: %d  cached: %d  cut off: %d  cost: $%.4f" % (
+        summary['steps'], summary['prompt_tokens'], summary['cached_tokens'], summary['completion_tokens'], summary['num_images'],
+        summary['attempts'], summary['cached'], summary['cutoff'], summary['cost'])]
+    for key in STEP_TIMINGS:
+        if key in summary:
+            lines.append("  %-13s total: %8.2fs  p50: %.3fs  p95: %.3fs  p99: %.3fs" % (
+                key, summary[key]['total'], summary[key]['p50'], summary[key]['p95'], summary[key]['p99']))
+    return '\n'.join(lines)
+
+
 def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_length=100):
     """
     Call in a loop to create terminal progress bar
@@ -1,7 +1,9 @@
 import json
 import os
 import time
-from utils.logger import write_to_record_file
+from utils.logger import write_to_record_file, StepRecorder, summarize_steps, format_step_summary
+from utils.journal import ResultJournal
+from vln.eval_utils import MetricsAccumulator
 
 
 class BaseAgent(object):
@@ -10,6 +12,11 @@ class BaseAgent(object):
     def __init__(self, env):
         self.env = env
         self.results = {}
+        self.journal = None
+        self.checkpoint_dir = None
+        self.case_listener = None   # called with the pred of every finished case
+        self.step_recorder = None
+        self.num_steps = 0          # steps taken by the last test
 
     def get_results(self, detailed_output=False):
         output = []
@@ -24,54 +31,118 @@ class BaseAgent(object):
 
     def test(self, iters=None, args=None, **kwargs):
         self.env.reset_epoch(shuffle=(iters is not None))   # If iters is not none, shuffle the env batch
-        self.results = {}
-        looped = False
+        self.resume_from_journal(args)
+        looped = len(self.env.data) == 0
 
-        while True:
+        while not looped:
             for traj in self.rollout(**kwargs):
                 if traj is None:
                     looped = True
                 else:
                     self.loss = 0
                     self.results[traj['instr_id']] = traj
+                    self.eval_case(traj, args)
+
+        self.eval_all_cases(args)
+
+    def resume_from_journal(self, args):
+        '''
+        Reload the cases finished by previous runs from the journal of the split
+        and only keep the other cases in the env. Records of cases outside the env data,
+        e.g. of another --start/--end range, are left out of the results and metrics.
+        '''
+        self.results = {}
+        instr_ids = set(item['instr_id'] for item in self.env.data)
+        self.running_metrics = MetricsAccumulator()
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = ResultJournal(
+            os.path.join(args.pred_dir, 'journal_%s.jsonl' % self.env.name), fsync_every=args.journal_fsync_every
+        )
+        if self.step_recorder is not None:
+            self.step_recorder.close()
+        self.step_recorder = StepRecorder(os.path.join(args.log_dir, 'steps_%s.jsonl' % self.env.name))
+        self.step_recorder.records = [r for r in self.step_recorder.records if r.get('instr_id') in instr_ids]
+        self.step_recorder.num_loaded = len(self.step_recorder.records)
+        self.checkpoint_dir = os.path.join(args.pred_dir, 'checkpoints')
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        for record in self.journal.records:
+            instr_id = record['instr_id']
+            if instr_id not in instr_ids:
+                continue
+            self.results[instr_id] = {
+                'instr_id': instr_id,
+                'path': record['trajectory'],
+                'a_t': {int(t): a for t, a in record['a_t'].items()},
+                'details': record.get('details', {}),
+            }
+            self.running_metrics.update({k: v[0] for k, v in record['evaluation'].items() if k != 'instr_id'})
+            if self.case_listener is not None:
+                self.case_listener(record)
+
+        if len(self.results) > 0:
+            self.env.data = [item for item in self.env.data if item['instr_id'] not in self.results]
+            print('Resumed %d finished cases from %s, %d left' % (
+                len(self.results), self.journal.path, len(self.env.data)))
+
+    def checkpoint_path(self, instr_id):
+        return os.path.join(self.checkpoint_dir, 'InstrID_%s.json' % instr_id)
+
+    def eval_case(self, traj, args):
+        instr_id = traj['instr_id']
+        pred = {'instr_id': instr_id, 'trajectory': traj['path'], 'a_t': traj['a_t']}
+        if args.detailed_output:
+            pred['details'] = traj['details']
+
+        # evaluating current case
+        score_summary, current_metrics = self.env.eval_metrics([pred], args.dataset)
+        loss_str = "Current case  -"
+        for metric, val in score_summary.items():
+            loss_str += '  %s: %.2f' % (metric, val)
+        print(loss_str)
 
-            if looped:
-                break
+        # O(1) update of the metrics over all cases so far
+        self.running_metrics.update({k: v[0] for k, v in current_metrics.items() if k != 'instr_id'})
+        loss_str = "Running (%d cases)  -" % self.running_metrics.count
+        for metric, val in self.running_metrics.summary().items():
+            loss_str += '  %s: %.2f' % (metric, val)
+        print(loss_str)
 
-            preds = self.get_results(detailed_output=args.detailed_output)
-            current_pred = [preds[-1]]
+        # add evaluation result
+        scan, gt_traj = self.env.gt_trajs[instr_id]
 
-            # evaluating current case
-            score_summary, current_metrics = self.env.eval_metrics(current_pred, args.dataset)
-            loss_str = "Current case  -"
-            for metric, val in score_summary.items():
-                loss_str += '  %s: %.2f' % (metric, val)
-            print(loss_str)
+        pred['scan'] = scan
+        pred['gt_traj'] = gt_traj
+        pred['evaluation'] = current_metrics
 
-            # add evaluation result
-            instr_id = preds[-1]['instr_id']
-            scan, gt_traj = self.env.gt_trajs[instr_id]
+        if self.journal is not None:
+            self.journal.append(pred)
+            if os.path.exists(self.checkpoint_path(instr_id)):
+                os.remove(self.checkpoint_path(instr_id))
 
-            preds[-1]['scan'] = scan
-            preds[-1]['gt_traj'] = gt_traj
-            preds[-1]['evaluation'] = current_metrics
+        if self.case_listener is not None:
+            self.case_listener(pred)
 
-            if args.save_pred:
-                json.dump(
-                    preds[-1],
-                    open(os.path.join(args.pred_dir, "case_InstrID_%s.json" % instr_id), 'w'),
-                    sort_keys=True, indent=4, separators=(',', ': ')
-                )
+        if args.save_pred:
+            json.dump(
+                pred,
+                open(os.path.join(args.pred_dir, "case_InstrID_%s.json" % instr_id), 'w'),
+                sort_keys=True, indent=4, separators=(',', ': ')
+            )
 
-        # evaluating all cases
-        score_summary, _ = self.env.eval_metrics(preds, args.dataset)
+    def eval_all_cases(self, args):
+        # evaluating all cases, from the running metrics
         loss_str = "All cases  -"
-        for metric, val in score_summary.items():
+        for metric, val in self.running_metrics.summary().items():
             loss_str += '  %s: %.2f' % (metric, val)
         record_file = os.path.join(args.log_dir, 'valid.txt')
         write_to_record_file(loss_str + '\n', record_file)
+        write_to_record_file(format_step_summary(summarize_steps(self.step_recorder.records)) + '\n', record_file)
 
-
-
-
-
+        self.num_steps = len(self.step_recorder.records) - self.step_recorder.num_loaded
+        self.journal.close()
+        self.journal = None
+        self.step_recorder.close()
+        self.step_recorder = None
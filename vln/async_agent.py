@@ -0,0 +1,60 @@
+import asyncio
+
+from GPT.one_stage_prompt_manager import OneStagePromptManager
+from GPT.api import agpt_infer
+from GPT.streaming import await_pending
+from .gpt_agent import GPTNavAgent
+
+
+class AsyncGPTNavAgent(GPTNavAgent):
+    """
+    Keeps args.parallel_episodes episodes in flight at once. Every episode runs in its own
+    simulator of the env batch with its own prompt manager, and the LLM queries of all episodes
+    are issued concurrently, at most args.llm_concurrency at a time.
+    """
+
+    def __init__(self, args, env, rank=0):
+        super().__init__(args, env, rank=rank)
+        self.num_slots = args.parallel_episodes
+        self.llm_concurrency = args.llm_concurrency or args.parallel_episodes
+        assert self.env.batch_size >= self.num_slots, \
+            'the env batch only has %d simulators' % self.env.batch_size
+
+    async def rollout_episode(self, env_id, item, prompt_manager):
+        obs = self.env.reset_slots([env_id], [item])
+        traj = self.init_traj(obs)
+        obs, checkpoint = self.restore_checkpoint(obs, traj, env_ids=[env_id])
+
+        navigation = self.navigate(prompt_manager, obs, traj, env_ids=[env_id], checkpoint=checkpoint)
+        try:
+            request = next(navigation)
+            while True:
+                async with self.llm_semaphore:
+                    response = await agpt_infer(**request)
+                request = navigation.send(response)
+        except StopIteration:
+            pass
+
+        return traj
+
+    async def _run_slot(self, env_id, items, args):
+        prompt_manager = OneStagePromptManager(self.args)
+        for item in items:      # the iterator is shared by all slots
+            traj = (await self.rollout_episode(env_id, item, prompt_manager))[0]
+            self.loss = 0
+            self.results[traj['instr_id']] = traj
+            self.eval_case(traj, args)
+
+    async def _test(self, args):
+        self.llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        items = iter(self.env.data)
+        await asyncio.gather(*[self._run_slot(env_id, items, args) for env_id in range(self.num_slots)])
+        await await_pending()
+
+    def test(self, iters=None, args=None, **kwargs):
+        self.env.reset_epoch(shuffle=(iters is not None))
+        self.resume_from_journal(args)
+
+        asyncio.run(self._test(args))
+
+        self.eval_all_cases(args)
@@ -0,0 +1,150 @@
+import os
+import time
+
+from openai.types import CompletionUsage
+
+from GPT.one_stage_prompt_manager import OneStagePromptManager
+from GPT.api import prepare_request, get_cached_response, put_cached_response, request_tokens
+from GPT.batch import write_batch_files, build_batch_backend
+from .gpt_agent import GPTNavAgent
+
+
+class BatchGPTNavAgent(GPTNavAgent):
+    """
+    Offline evaluation through a batch backend (GPT/batch.py). args.parallel_episodes episodes
+    advance in lockstep: every round, the pending requests of all live episodes go into one batch,
+    and each episode takes one step with its answer. A finished episode hands its simulator to the
+    next one, whose first request joins the next round. An episode whose request fails
+    max_request_attempts times stops where it is.
+    """
+
+    max_request_attempts = 3
+
+    def __init__(self, args, env, rank=0):
+        super().__init__(args, env, rank=rank)
+        if args.llm_stream:
+            raise ValueError('--llm_stream does not apply to batch requests')
+        self.num_slots = args.parallel_episodes
+        self.backend = build_batch_backend(args)
+        assert self.env.batch_size >= self.num_slots, \
+            'the env batch only has %d simulators' % self.env.batch_size
+
+    def start_episode(self, env_id, items):
+        ''' Start the next unfinished episode in the simulator env_id, return its slot or None '''
+        for item in items:
+            obs = self.env.reset_slots([env_id], [item])
+            traj = self.init_traj(obs)
+            obs, checkpoint = self.restore_checkpoint(obs, traj, env_ids=[env_id])
+
+            prompt_manager = OneStagePromptManager(self.args)
+            navigation = self.navigate(prompt_manager, obs, traj, env_ids=[env_id], checkpoint=checkpoint)
+            try:
+                request = next(navigation)
+            except StopIteration:
+                self.finish_episode(traj)
+                continue
+            return {'traj': traj, 'navigation': navigation, 'request': request, 'attempts': 0}
+        return None
+
+    def finish_episode(self, traj):
+        traj = traj[0]
+        self.loss = 0
+        self.results[traj['instr_id']] = traj
+        self.eval_case(traj, self.test_args)
+
+    def step_episode(self, slot, response):
+        ''' Send the answer to the episode, return False once it is over '''
+        try:
+            slot['request'] = slot['navigation'].send(response)
+            slot['attempts'] = 0
+            return True
+        except StopIteration:
+            self.finish_episode(slot['traj'])
+            return False
+
+    def run_round(self, slots, round_idx):
+        batch_dir = os.path.join(self.args.pred_dir, 'batches')
+        os.makedirs(batch_dir, exist_ok=True)
+
+        responses, pending = {}, {}
+        for env_id, slot in slots.items():
+            body, cache_key = prepare_request(**slot['request'])
+            cached = get_cached_response(cache_key, slot['request'].get('stats'))
+            if cached is not None:
+                responses[env_id] = cached
+            else:
+                pending[str(env_id)] = (body, cache_key)
+
+        if len(pending) > 0:
+            tic = time.time()
+            paths = write_batch_files([(custom_id, body) for custom_id, (body, _) in pending.items()],
+                                      os.path.join(batch_dir, '%s_round%05d' % (self.env.name, round_idx)))
+            # the estimates the client-side limiter (--max_tpm) charges to the local batch requests
+            tokens = {}
+            for custom_id in pending:
+                request = slots[int(custom_id)]['request']
+                tokens[custom_id] = request_tokens(request['system'], request['text'], request['image_list'],
+                                                   request['max_tokens'], request.get('prefix_text'))
+            results = self.backend.run(paths, request_tokens=tokens)
+            request_time = time.time() - tic
+            print('Round %d: %d requests, %d cached, %.2fs' % (
+                round_idx, len(pending), len(slots) - len(pending), request_time))
+
+            for result in results:
+                env_id = int(result['custom_id'])
+                stats = slots[env_id]['request'].get('stats')
+                if stats is not None:
+                    stats['attempts'] = slots[env_id]['attempts'] + 1
+                    stats['request_time'] = request_time
+                response = result.get('response')
+                if result.get('error') is not None or response is None or response['status_code'] != 200:
+                    print('Request of %s failed: %s' % (slots[env_id]['traj'][0]['instr_id'],
+                                                        result.get('error') or response))
+                    continue
+                answer = response['body']['choices'][0]['message']['content']
+                usage = CompletionUsage(**response['body']['usage'])
+                put_cached_response(pending[result['custom_id']][1], answer, usage)
+                responses[env_id] = (answer, usage)
+
+        return responses
+
+    def test(self, iters=None, args=None, **kwargs):
+        self.env.reset_epoch(shuffle=(iters is not None))
+        self.resume_from_journal(args)
+        self.test_args = args
+
+        items = iter(self.env.data)
+        slots = {}
+        for env_id in range(self.num_slots):
+            slot = self.start_episode(env_id, items)
+            if slot is not None:
+                slots[env_id] = slot
+
+        round_idx = 0
+        while len(slots) > 0:
+            responses = self.run_round(slots, round_idx)
+            round_idx += 1
+
+            for env_id in list(slots.keys()):
+                slot = slots[env_id]
+                if env_id not in responses:
+                    # resubmitted with the next round
+                    slot['attempts'] += 1
+                    if slot['attempts'] < self.max_request_attempts:
+                        continue
+                    # the episode stops where it is, the rest of the batch goes on
+                    print('The request of %s failed %d times, stopping the episode' % (
+                        slot['traj'][0]['instr_id'], slot['attempts']))
+                    slot['navigation'].close()
+                    self.finish_episode(slot['traj'])
+                    running = False
+                else:
+                    running = self.step_episode(slot, responses[env_id])
+                if not running:
+                    slot = self.start_episode(env_id, items)
+                    if slot is None:
+                        del slots[env_id]
+                    else:
+                        slots[env_id] = slot
+
+        self.eval_all_cases(args)
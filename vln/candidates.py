@@ -0,0 +1,219 @@
+''' Navigable candidates of every viewpoint, precomputed with the 36-view simulator sweep.
+
+    python -m vln.candidates --root_dir ../datasets [--scans scan1 scan2 ...]
+
+writes one columnar <scan>_candidates.npz per scan to R2R/candidates, which R2RNavBatch.make_candidate
+then serves without calling the simulator.
+'''
+import os
+import json
+import math
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from utils.data import new_simulator
+from utils.graph import LazyScanDict
+
+
+# per-candidate columns, besides the viewpoint ids
+COLUMNS = ['point_id', 'idx', 'absolute_heading', 'absolute_elevation', 'rel_heading', 'rel_elevation', 'position']
+
+
+def sweep_viewpoint(sim, scanId, viewpointId):
+    """
+    Look around a viewpoint through the 36 discretized views and keep, for every navigable location,
+    the view where it is closest to the view center.
+    :return: [(viewpointId, pointId, idx, absolute_heading, absolute_elevation, rel_heading, rel_elevation, position)]
+    """
+    def _loc_distance(loc):
+        return np.sqrt(loc.rel_heading ** 2 + loc.rel_elevation ** 2)
+
+    adj_dict = {}
+    for ix in range(36):
+        if ix == 0:
+            sim.newEpisode([scanId], [viewpointId], [0], [math.radians(-30)])
+        elif ix % 12 == 0:
+            sim.makeAction([0], [1.0], [1.0])
+        else:
+            sim.makeAction([0], [1.0], [0])
+
+        state = sim.getState()[0]
+        assert state.viewIndex == ix
+
+        # get adjacent locations
+        for j, loc in enumerate(state.navigableLocations[1:]):
+            distance = _loc_distance(loc)
+            if (loc.viewpointId not in adj_dict or
+                    distance < adj_dict[loc.viewpointId][0]):
+                adj_dict[loc.viewpointId] = (distance, (
+                    loc.viewpointId, ix, j + 1, state.heading, state.elevation,
+                    loc.rel_heading, loc.rel_elevation, (loc.x, loc.y, loc.z)
+                ))
+
+    return [row for _, row in adj_dict.values()]
+
+
+def load_viewpoints(connectivity_dir, scan):
+    with open(os.path.join(connectivity_dir, '%s_connectivity.json' % scan)) as f:
+        return [item['image_id'] for item in json.load(f) if item['included']]
+
+
+def build_candidate_table(sim, connectivity_dir, scan, output_file):
+    viewpoints = load_viewpoints(connectivity_dir, scan)
+    vp_index = {vp: i for i, vp in enumerate(viewpoints)}
+
+    offsets = [0]
+    cand_vps = []
+    columns = {key: [] for key in COLUMNS}
+    for viewpointId in viewpoints:
+        for row in sweep_viewpoint(sim, scan, viewpointId):
+            cand_vps.append(vp_index[row[0]])
+            for key, value in zip(COLUMNS, row[1:]):
+                columns[key].append(value)
+        offsets.append(len(cand_vps))
+
+    np.savez(
+        output_file,
+        viewpoints=np.array(viewpoints),
+        offsets=np.array(offsets, dtype=np.int64),
+        viewpoint_id=np.array(cand_vps, dtype=np.int32),
+        point_id=np.array(columns['point_id'], dtype=np.int8),
+        idx=np.array(columns['idx'], dtype=np.int16),
+        # float64 keeps the angles bit-for-bit equal to the simulator outputs
+        absolute_heading=np.array(columns['absolute_heading'], dtype=np.float64),
+        absolute_elevation=np.array(columns['absolute_elevation'], dtype=np.float64),
+        rel_heading=np.array(columns['rel_heading'], dtype=np.float64),
+        rel_elevation=np.array(columns['rel_elevation'], dtype=np.float64),
+        position=np.array(columns['position'], dtype=np.float64).reshape(-1, 3),
+    )
+    return len(viewpoints), len(cand_vps)
+
+
+class CandidateTable(object):
+    ''' Precomputed sweep results of one scan '''
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.viewpoints = data['viewpoints'].tolist()
+            self.columns = {key: data[key] for key in ['offsets', 'viewpoint_id'] + COLUMNS}
+        self.index = {vp: i for i, vp in enumerate(self.viewpoints)}
+
+    def get(self, viewpointId):
+        """ Same rows as sweep_viewpoint, or None for an unknown viewpoint """
+        i = self.index.get(viewpointId)
+        if i is None:
+            return None
+
+        c = self.columns
+        start, end = c['offsets'][i], c['offsets'][i + 1]
+        return [(
+            self.viewpoints[c['viewpoint_id'][k]], int(c['point_id'][k]), int(c['idx'][k]),
+            float(c['absolute_heading'][k]), float(c['absolute_elevation'][k]),
+            float(c['rel_heading'][k]), float(c['rel_elevation'][k]),
+            tuple(float(x) for x in c['position'][k]),
+        ) for k in range(start, end)]
+
+
+class CandidateTables(object):
+    ''' {scan: CandidateTable} of the tables present in candidate_dir, loaded on first use '''
+
+    def __init__(self, candidate_dir, max_size=None):
+        self.candidate_dir = candidate_dir
+        self.tables = LazyScanDict(
+            lambda scan: CandidateTable(self._path(scan)), max_size=max_size
+        )
+
+    def _path(self, scan):
+        return os.path.join(self.candidate_dir, '%s_candidates.npz' % scan)
+
+    def get(self, scanId, viewpointId):
+        if self.candidate_dir is None or not os.path.exists(self._path(scanId)):
+            return None
+        return self.tables[scanId].get(viewpointId)
+
+
+CANDIDATE_FIELDS = ['scanId', 'viewpointId', 'pointId', 'idx', 'distance', 'position', 'image',
+                    'absolute_heading', 'absolute_elevation', 'normalized_heading', 'normalized_elevation',
+                    'view_heading', 'view_elevation']
+
+
+class Candidate(namedtuple('Candidate', CANDIDATE_FIELDS)):
+    """
+    Read-only record of a navigable viewpoint seen from a view of the agent, indexed like the
+    former candidate dicts (cand['pointId']). heading and elevation, relative to the view, are
+    computed on access.
+    """
+    __slots__ = ()
+
+    caption = None  # used for a two-stage system
+    pretrained_inference = None
+
+    @property
+    def heading(self):
+        return self.normalized_heading - self.view_heading
+
+    @property
+    def elevation(self):
+        return self.normalized_elevation - self.view_elevation
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+
+def view_angles(viewId):
+    return (viewId % 12) * math.radians(30), (viewId // 12 - 1) * math.radians(30)
+
+
+def make_candidates(rows, scanId, viewpointId, viewId, img_root):
+    ''' Candidate records of the sweep rows of a viewpoint, seen from view viewId '''
+    view_heading, view_elevation = view_angles(viewId)
+    img_dir = os.path.join(img_root, scanId, viewpointId)
+    return tuple([
+        tuple.__new__(Candidate, (
+            scanId, cand_vp, ix, idx, math.sqrt(rel_heading ** 2 + rel_elevation ** 2), position,
+            os.path.join(img_dir, str(ix) + '.jpg'),
+            abs_heading, abs_elevation, abs_heading + rel_heading, abs_elevation + rel_elevation,
+            view_heading, view_elevation))
+        for (cand_vp, ix, idx, abs_heading, abs_elevation, rel_heading, rel_elevation, position) in rows
+    ])
+
+
+def view_candidates(candidates, viewId):
+    ''' The same candidates seen from another view '''
+    view = view_angles(viewId)
+    return tuple([tuple.__new__(Candidate, c[:-2] + view) for c in candidates])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--root_dir', type=str, default='../datasets')
+    parser.add_argument('--output_dir', type=str, default=None, help='default: <root_dir>/R2R/candidates')
+    parser.add_argument('--scans', type=str, nargs='*', default=None)
+    args = parser.parse_args()
+
+    connectivity_dir = os.path.join(args.root_dir, 'R2R', 'connectivity')
+    output_dir = args.output_dir or os.path.join(args.root_dir, 'R2R', 'candidates')
+    os.makedirs(output_dir, exist_ok=True)
+
+    scans = args.scans
+    if not scans:
+        scans = sorted(name[:-len('_connectivity.json')] for name in os.listdir(connectivity_dir)
+                       if name.endswith('_connectivity.json'))
+
+    sim = new_simulator(connectivity_dir)
+    for scan in scans:
+        num_vps, num_cands = build_candidate_table(
+            sim, connectivity_dir, scan, os.path.join(output_dir, '%s_candidates.npz' % scan)
+        )
+        print('%s: %d viewpoints, %d candidates' % (scan, num_vps, num_cands))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,32 @@
 import os
 import json
+import argparse
+
+import numpy as np
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+def instr_file(anno_dir, dataset, split, tokenizer):
+    if 'sample' in split:
+        return os.path.join(anno_dir, split)
+    if tokenizer == 'bert':
+        return os.path.join(anno_dir, '%s_%s_enc.json' % (dataset.upper(), split))
+    elif tokenizer == 'xlm':
+        return os.path.join(anno_dir, '%s_%s_enc_xlmr.json' % (dataset.upper(), split))
+    else:
+        raise NotImplementedError('unsupported tokenizer %s' % tokenizer)
 
 
 def load_instr_datasets(anno_dir, dataset, splits, tokenizer, is_test=True):
     data = []
     for split in splits:
-        if 'sample' in split:
-            filepath = os.path.join(anno_dir, split)
-            with open(filepath) as f:
-                new_data = json.load(f)
-
-        elif "/" not in split:    # the official splits
-            if tokenizer == 'bert':
-                filepath = os.path.join(anno_dir, '%s_%s_enc.json' % (dataset.upper(), split))
-            elif tokenizer == 'xlm':
-                filepath = os.path.join(anno_dir, '%s_%s_enc_xlmr.json' % (dataset.upper(), split))
-            else:
-                raise NotImplementedError('unsupported tokenizer %s' % tokenizer)
-
-            with open(filepath) as f:
+        if 'sample' in split or "/" not in split:    # the official splits
+            with open(instr_file(anno_dir, dataset, split, tokenizer)) as f:
                 new_data = json.load(f)
 
             if split == 'val_train_seen':
@@ -28,21 +36,115 @@ def load_instr_datasets(anno_dir, dataset, splits, tokenizer, is_test=True):
         data += new_data
     return data
 
-def construct_instrs(anno_dir, dataset, splits, tokenizer, max_instr_len=512, is_test=True):
-    data = []
-    for i, item in enumerate(load_instr_datasets(anno_dir, dataset, splits, tokenizer, is_test=is_test)):
+
+def split_instructions(data):
+    ''' One item per instruction, with its instr_id, instruction and instr_encoding '''
+    for item in data:
         # Split multiple instructions into separate entries
         for j, instr in enumerate(item['instructions']):
-            new_item = dict(item)
+            new_item = {key: value for key, value in item.items() if key not in ('instructions', 'instr_encodings')}
             new_item['instr_id'] = '%s_%d' % (item['path_id'], j)
             new_item['instruction'] = instr
-            new_item['instr_encoding'] = item['instr_encodings'][j][:max_instr_len]
-            del new_item['instructions']
-            del new_item['instr_encodings']
-            data.append(new_item)
+            new_item['instr_encoding'] = item['instr_encodings'][j]
+            yield new_item
+
+
+def construct_instrs(anno_dir, dataset, splits, tokenizer, max_instr_len=512, is_test=True, fields=None, exclude=None):
+    ''' fields / exclude: the keys to keep / drop, e.g. the instr_encoding that MapGPT does not use '''
+    data = []
+    for split in splits:
+        index = open_instrs(anno_dir, dataset, split, tokenizer)
+        for item in index.load(fields=fields, exclude=exclude):
+            if 'instr_encoding' in item:
+                item['instr_encoding'] = item['instr_encoding'][:max_instr_len]
+            data.append(item)
     return data
 
 
+def open_instrs(anno_dir, dataset, split, tokenizer):
+    ''' AnnotationIndex of a split, one item per instruction as in construct_instrs '''
+    index_name = '%s_%s_%s' % (dataset.upper(), split.replace('/', '_'), tokenizer)
+    return open_annotations(instr_file(anno_dir, dataset, split, tokenizer), index_dir(anno_dir), index_name,
+                            convert=lambda items: split_instructions(items[:50] if split == 'val_train_seen' else items))
+
+
+def index_dir(anno_dir):
+    return os.path.join(anno_dir, 'indexed')
+
+
+class AnnotationIndex(object):
+    """
+    A split converted to JSONL, one item per line, with the byte offsets of its lines in
+    <name>.offsets.npy: a range of items is read and parsed without loading the whole split.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path[:-len('.jsonl')] + '.offsets.npy')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def load(self, start=0, end=None, fields=None, exclude=None):
+        ''' Items [start:end] (python slice semantics), with only the given fields / without the excluded ones '''
+        start, end, _ = slice(start, end).indices(len(self))
+        if start >= end:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(int(self.offsets[start]))
+            lines = f.read(int(self.offsets[end] - self.offsets[start])).splitlines()
+        items = [json_loads(line) for line in lines]
+        if fields is not None:
+            items = [{key: item[key] for key in fields if key in item} for item in items]
+        if exclude is not None:
+            items = [{key: value for key, value in item.items() if key not in exclude} for item in items]
+        return items
+
+
+def convert_annotations(items, path):
+    ''' Write the items as the JSONL file path and its offsets, see AnnotationIndex '''
+    offsets = [0]
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        for item in items:
+            line = json.dumps(item).encode('utf-8') + b'\n'
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    offsets_path = path[:-len('.jsonl')] + '.offsets.npy'
+    np.save(offsets_path + '.tmp%d.npy' % os.getpid(), np.array(offsets, dtype=np.int64))
+    # the offsets go last, they mark a complete conversion
+    os.replace(tmp_path, path)
+    os.replace(offsets_path + '.tmp%d.npy' % os.getpid(), offsets_path)
+    return len(offsets) - 1
+
+
+def open_annotations(source, output_dir, name=None, convert=None):
+    '''
+    AnnotationIndex of the json file source, converted on first use or when the source changed.
+    convert: optional function of the loaded items returning the items to index.
+    '''
+    if name is None:
+        name = os.path.splitext(os.path.basename(source))[0]
+    path = os.path.join(output_dir, name + '.jsonl')
+    offsets_path = os.path.join(output_dir, name + '.offsets.npy')
+    if not os.path.exists(offsets_path) or os.path.getmtime(offsets_path) < os.path.getmtime(source):
+        os.makedirs(output_dir, exist_ok=True)
+        with open(source) as f:
+            items = json.load(f)
+        num_items = convert_annotations(items if convert is None else convert(items), path)
+        print('Indexed %d items of %s in %s' % (num_items, source, path))
+    return AnnotationIndex(path)
+
+
+def shard_range(num_items, shard, num_shards):
+    ''' [start, end) of a shard of num_items, the last shard takes the remainder '''
+    ndata_per_split = num_items // num_shards
+    start_idx = ndata_per_split * shard
+    if shard == num_shards - 1:
+        return start_idx, num_items
+    return start_idx, start_idx + ndata_per_split
+
+
 def load_obj2vps(bbox_file):
     obj2vps = {}
     bbox_data = json.load(open(bbox_file))
@@ -52,4 +154,19 @@ def load_obj2vps(bbox_file):
             if objinfo['visible_pos']:
                 obj2vps.setdefault(scan+'_'+objid, [])
                 obj2vps[scan+'_'+objid].append(vp)
-    return obj2vps
\ No newline at end of file
+    return obj2vps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('--anno_dir', type=str, default='../datasets/R2R/annotations')
+    parser.add_argument('--splits', type=str, nargs='+', required=True, help='processed splits, e.g. MapGPT_72_scenes_processed')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        index = open_annotations(os.path.join(args.anno_dir, split + '.json'), index_dir(args.anno_dir))
+        print('%s: %d items' % (split, len(index)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,60 @@
 ''' Batched navigation environment '''
-import MatterSim
 import json
 import numpy as np
 import math
 import random
-import networkx as nx
+import threading
 from collections import defaultdict
 import os
 
-from utils.data import load_nav_graphs, new_simulator
+from utils.data import new_simulator
+from utils.connectivity import load_connectivity
+from utils.graph import load_shortest_paths, LazyScanDict, DistanceTable, PathTable, ScanViews
 
-from vln.eval_utils import cal_dtw, cal_cls
-from vln.data_utils import load_obj2vps
+from vln.eval_utils import cal_dtw_batch, cal_cls_idx
+from vln.data_utils import load_obj2vps, shard_range
+from vln.candidates import sweep_viewpoint, CandidateTables, make_candidates, view_candidates
+from vln.graph_env import GraphSimulator
 
 ERROR_MARGIN = 3.0
 
 
+class Observation(object):
+    ''' Observation of an agent, indexed like the former observation dicts (ob['viewpoint']) '''
+
+    __slots__ = ('instr_id', 'scan', 'viewpoint', 'viewIndex', 'position', 'heading', 'elevation', 'candidate',
+                 'instruction', 'instr_encoding', 'gt_path', 'path_id', 'distance', 'state')
+
+    surrounding_tags = None
+
+    def __init__(self, item, state, candidate, distance):
+        self.instr_id = item['instr_id']
+        self.scan = state.scanId
+        self.viewpoint = state.location.viewpointId
+        self.viewIndex = state.viewIndex
+        self.position = (state.location.x, state.location.y, state.location.z)
+        self.heading = state.heading
+        self.elevation = state.elevation
+        self.candidate = candidate
+        self.instruction = item['instruction']
+        self.instr_encoding = item.get('instr_encoding')
+        self.gt_path = item['path']
+        self.path_id = item['path_id']
+        self.distance = distance
+        self.state = state
+
+    @property
+    def navigableLocations(self):
+        # read from the simulator state on access
+        return self.state.navigableLocations
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
 class EnvBatch(object):
     ''' A simple wrapper for a batch of MatterSim environments,
         using discretized viewpoints and pretrained features '''
@@ -27,6 +66,8 @@ class EnvBatch(object):
         :param feat_db: The name of file stored the feature.
         :param batch_size:  Used to create the simulator list.
         """
+        import MatterSim
+
         self.feat_db = feat_db
         self.image_w = 640
         self.image_h = 480
@@ -49,11 +90,15 @@ class EnvBatch(object):
     def _make_id(self, scanId, viewpointId):
         return scanId + '_' + viewpointId
 
-    def newEpisodes(self, scanIds, viewpointIds, headings):
-        for i, (scanId, viewpointId, heading) in enumerate(zip(scanIds, viewpointIds, headings)):
-            self.sims[i].newEpisode([scanId], [viewpointId], [heading], [0])
+    def newEpisodes(self, scanIds, viewpointIds, headings, env_ids=None, elevations=None):
+        if env_ids is None:
+            env_ids = range(len(scanIds))
+        if elevations is None:
+            elevations = [0] * len(scanIds)
+        for i, scanId, viewpointId, heading, elevation in zip(env_ids, scanIds, viewpointIds, headings, elevations):
+            self.sims[i].newEpisode([scanId], [viewpointId], [heading], [elevation])
 
-    def getStates(self):
+    def getStates(self, env_ids=None):
         """
         Get list of states augmented with precomputed image features. rgb field will be empty.
         Agent's current view [0-35] (set only when viewing angles are discretized)
@@ -61,9 +106,11 @@ class EnvBatch(object):
         :return: [ ((36, 2048), sim_state) ] * batch_size
         """
         # feature_states = []
+        if env_ids is None:
+            env_ids = range(len(self.sims))
         states = []
-        for i, sim in enumerate(self.sims):
-            state = sim.getState()[0]
+        for i in env_ids:
+            state = self.sims[i].getState()[0]
             states.append(state)
         return states
 
@@ -74,14 +121,30 @@ class EnvBatch(object):
             self.sims[i].makeAction([index], [heading], [elevation])
 
 
+class GraphEnvBatch(EnvBatch):
+    ''' EnvBatch on the connectivity graphs and precomputed candidate tables, without MatterSim '''
+
+    def __init__(self, connectivity, candidate_tables, batch_size=100):
+        positions = LazyScanDict(lambda scan: connectivity[scan].position_dict())
+        self.sims = [GraphSimulator(positions, candidate_tables) for _ in range(batch_size)]
+
+
 class R2RNavBatch(object):
     def __init__(
         self, instr_data, connectivity_dir, view_db=None,
         batch_size=64, seed=0, name=None, sel_data_idxs=None, args=None
     ):
-        self.env = EnvBatch(connectivity_dir, feat_db=view_db, batch_size=batch_size,
-                            scan_data_dir=args.scan_data_dir,  # for visualization
-                            )
+        self.candidate_tables = CandidateTables(args.candidate_dir, max_size=args.max_cached_scans)
+        self.connectivity = LazyScanDict(
+            lambda scan: load_connectivity(connectivity_dir, scan, args.graph_cache_dir),
+            max_size=args.max_cached_scans
+        )
+        if args.env_backend == 'graph':
+            self.env = GraphEnvBatch(self.connectivity, self.candidate_tables, batch_size=batch_size)
+        else:
+            self.env = EnvBatch(connectivity_dir, feat_db=view_db, batch_size=batch_size,
+                                scan_data_dir=args.scan_data_dir,  # for visualization
+                                )
         self.data = instr_data
         self.scans = set([x['scan'] for x in self.data])
         self.connectivity_dir = connectivity_dir
@@ -93,13 +156,7 @@ class R2RNavBatch(object):
 
         # in validation, we would split the data
         if sel_data_idxs is not None:
-            t_split, n_splits = sel_data_idxs
-            ndata_per_split = len(self.data) // n_splits 
-            start_idx = ndata_per_split * t_split
-            if t_split == n_splits - 1:
-                end_idx = None
-            else:
-                end_idx = start_idx + ndata_per_split
+            start_idx, end_idx = shard_range(len(self.data), *sel_data_idxs)
             self.data = self.data[start_idx: end_idx]
 
         self.seed = seed
@@ -107,9 +164,13 @@ class R2RNavBatch(object):
         self.ix = 0
         self._load_nav_graphs()
 
-        self.sim = new_simulator(self.connectivity_dir)
+        # only created if a viewpoint is missing from the candidate tables
+        self.sim = None
+        self.swept_rows = {}
+        self.sweep_lock = threading.Lock()   # the sweep may also run in the prefetch thread
 
         self.buffered_state_dict = {}
+        self.buffered_views = {}
         print('%s loaded with %d instructions, using splits: %s' % (
             self.__class__.__name__, len(self.data), self.name))
 
@@ -125,21 +186,24 @@ class R2RNavBatch(object):
 
     def _load_nav_graphs(self):
         """
-        load graph from self.scan,
-        Store the graph {scan_id: graph} in self.graphs
-        Store the shortest path {scan_id: {view_id_x: {view_id_y: [path]} } } in self.paths
-        Store the distances in self.distances. (Structure see above)
-        Load connectivity graph for each scan, useful for reasoning about shortest paths
+        Prepare the lazy per-scan graph data, each scan is loaded the first time it is used,
+        keeping at most args.max_cached_scans scans in memory.
+        The binary graphs {scan_id: ScanConnectivity} are in self.connectivity, see utils/connectivity.py
+        Store the networkx graph {scan_id: graph} in self.graphs, only built if used
+        Store the shortest paths {scan_id: ScanShortestPaths} in self.scan_paths
+        Store read-only views {scan_id: {view_id_x: {view_id_y: [path]} } } in self.shortest_paths
+        Store the distances in self.shortest_distances. (Structure see above)
+        The all-pairs matrices are cached in args.graph_cache_dir, see utils/graph.py
         :return: None
         """
-        print('Loading navigation graphs for %d scans' % len(self.scans))
-        self.graphs = load_nav_graphs(self.connectivity_dir, self.scans)
-        self.shortest_paths = {}
-        for scan, G in self.graphs.items():  # compute all shortest paths
-            self.shortest_paths[scan] = dict(nx.all_pairs_dijkstra_path(G))
-        self.shortest_distances = {}
-        for scan, G in self.graphs.items():  # compute all shortest paths
-            self.shortest_distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
+        max_size = self.args.max_cached_scans
+        self.graphs = LazyScanDict(lambda scan: self.connectivity[scan].graph, max_size=max_size)
+        self.scan_paths = LazyScanDict(
+            lambda scan: load_shortest_paths(self.connectivity_dir, scan, self.args.graph_cache_dir),
+            max_size=max_size
+        )
+        self.shortest_paths = ScanViews(self.scan_paths, PathTable)
+        self.shortest_distances = ScanViews(self.scan_paths, DistanceTable)
 
     def _next_minibatch(self, batch_size=None, **kwargs):
         """
@@ -164,124 +228,55 @@ class R2RNavBatch(object):
             random.shuffle(self.data)
         self.ix = 0
 
-    def make_candidate(self, scanId, viewpointId, viewId):
-        def _loc_distance(loc):
-            return np.sqrt(loc.rel_heading ** 2 + loc.rel_elevation ** 2)
+    def get_candidate_rows(self, scanId, viewpointId):
+        ''' Sweep results of a viewpoint, see vln/candidates.py '''
+        # served from the precomputed tables of vln/candidates.py when available
+        rows = self.candidate_tables.get(scanId, viewpointId)
+        if rows is not None:
+            return rows
 
-        base_heading = (viewId % 12) * math.radians(30)
-        base_elevation = (viewId // 12 - 1) * math.radians(30)
-
-        adj_dict = {}
         long_id = "%s_%s" % (scanId, viewpointId)
+        assert self.args.env_backend != 'graph', \
+            '%s is missing from the candidate tables, run python -m vln.candidates' % long_id
+        with self.sweep_lock:
+            if long_id not in self.swept_rows:
+                if self.sim is None:
+                    self.sim = new_simulator(self.connectivity_dir)
+                self.swept_rows[long_id] = sweep_viewpoint(self.sim, scanId, viewpointId)
+            return self.swept_rows[long_id]
 
-        if long_id not in self.buffered_state_dict:
-            for ix in range(36):
-                if ix == 0:
-                    self.sim.newEpisode([scanId], [viewpointId], [0], [math.radians(-30)])
-                elif ix % 12 == 0:
-                    self.sim.makeAction([0], [1.0], [1.0])
-                else:
-                    self.sim.makeAction([0], [1.0], [0])
-
-                state = self.sim.getState()[0]
-                assert state.viewIndex == ix
-
-                # Heading and elevation for the viewpoint center
-                heading = state.heading - base_heading
-                elevation = state.elevation - base_elevation
-
-                # get adjacent locations
-                for j, loc in enumerate(state.navigableLocations[1:]):
-                    distance = _loc_distance(loc)
-
-                    # Heading and elevation for for the loc
-                    loc_heading = heading + loc.rel_heading
-                    loc_elevation = elevation + loc.rel_elevation
-                    # angle_feat = angle_feature(loc_heading, loc_elevation, self.angle_feat_size)
-                    if (loc.viewpointId not in adj_dict or
-                            distance < adj_dict[loc.viewpointId]['distance']):
-
-                        blip2_caption = None  # used for a two-stage system
-                        img_path = os.path.join(self.args.img_root, scanId, viewpointId, str(ix) + '.jpg')
-
-                        adj_dict[loc.viewpointId] = {
-                            'heading': loc_heading,
-                            'elevation': loc_elevation,
-                            "normalized_heading": state.heading + loc.rel_heading,
-                            "normalized_elevation": state.elevation + loc.rel_elevation,
-                            'scanId': scanId,
-                            'viewpointId': loc.viewpointId, # Next viewpoint id
-                            'pointId': ix,
-                            'distance': distance,
-                            'idx': j + 1,
-                            'position': (loc.x, loc.y, loc.z),
-                            'caption': blip2_caption,
-                            'image': img_path,
-                            'absolute_heading': state.heading,
-                            'absolute_elevation': state.elevation,
-                        }
-
-            candidate = list(adj_dict.values())
-            for cand in candidate:
-                cand['pretrained_inference'] = None
-
-            self.buffered_state_dict[long_id] = [
-                {key: c[key]
-                 for key in
-                    ['normalized_heading', 'normalized_elevation', 'scanId', 'viewpointId',
-                     'pointId', 'idx', 'position','caption', 'image', 'absolute_heading', 'absolute_elevation',
-                     'pretrained_inference', 'distance']}
-                for c in candidate
-            ]
-            return candidate
-        else:
-            candidate = self.buffered_state_dict[long_id]
-            candidate_new = []
-            for c in candidate:
-                c_new = c.copy()
-                c_new['heading'] = c_new['normalized_heading'] - base_heading
-                c_new['elevation'] = c_new['normalized_elevation'] - base_elevation
-                c_new.pop('normalized_heading')
-                c_new.pop('normalized_elevation')
-                candidate_new.append(c_new)
-
-            return candidate_new
-
-    def _get_obs(self):
+    def make_candidate(self, scanId, viewpointId, viewId):
+        ''' Candidate records seen from a view, built once and shared by every step at that view '''
+        key = (scanId, viewpointId, viewId)
+        candidate = self.buffered_views.get(key)
+        if candidate is None:
+            long_id = "%s_%s" % (scanId, viewpointId)
+            if long_id not in self.buffered_state_dict:
+                rows = self.get_candidate_rows(scanId, viewpointId)
+                candidate = make_candidates(rows, scanId, viewpointId, viewId, self.args.img_root)
+                self.buffered_state_dict[long_id] = candidate
+            else:
+                candidate = view_candidates(self.buffered_state_dict[long_id], viewId)
+            self.buffered_views[key] = candidate
+        return candidate
+
+    def _get_obs(self, env_ids=None):
+        if env_ids is None:
+            env_ids = range(len(self.batch))
         obs = []
-        for i, state in enumerate(self.env.getStates()):
+        for i, state in zip(env_ids, self.env.getStates(env_ids)):
             item = self.batch[i]
 
             candidate = self.make_candidate(state.scanId, state.location.viewpointId, state.viewIndex)
 
-            if 'instr_encoding' in item.keys():
-                instr_encoding = item['instr_encoding']
-            else:
-                instr_encoding = None
-
-            ob = {
-                'instr_id' : item['instr_id'],
-                'scan' : state.scanId,
-                'viewpoint' : state.location.viewpointId,
-                'viewIndex' : state.viewIndex,
-                'position': (state.location.x, state.location.y, state.location.z),
-                'heading' : state.heading,
-                'elevation' : state.elevation,
-                'candidate': candidate,
-                'navigableLocations' : state.navigableLocations,
-                'instruction' : item['instruction'],
-                'instr_encoding': instr_encoding, # item['instr_encoding'],
-                'gt_path' : item['path'],
-                'path_id' : item['path_id'],
-                'surrounding_tags': None
-            }
             # RL reward. The negative distance between the state and the final state
             # There are multiple gt end viewpoints on REVERIE. 
-            if ob['instr_id'] in self.gt_trajs:
-                ob['distance'] = self.shortest_distances[ob['scan']][ob['viewpoint']][item['path'][-1]]
+            if item['instr_id'] in self.gt_trajs:
+                distance = self.shortest_distances[state.scanId][state.location.viewpointId][item['path'][-1]]
             else:
-                ob['distance'] = 0
+                distance = 0
 
+            ob = Observation(item, state, candidate, distance)
             obs.append(ob)
         return obs
 
@@ -295,51 +290,61 @@ class R2RNavBatch(object):
         self.env.newEpisodes(scanIds, viewpointIds, headings)
         return self._get_obs()
 
+    def reset_slots(self, env_ids, items):
+        ''' Start the episodes of items in the given simulators, leaving the others untouched. '''
+        if not hasattr(self, 'batch') or len(self.batch) != self.batch_size:
+            self.batch = [None] * self.batch_size
+        for i, item in zip(env_ids, items):
+            self.batch[i] = item
+
+        scanIds = [item['scan'] for item in items]
+        viewpointIds = [item['path'][0] for item in items]
+        headings = [item['heading'] for item in items]
+        self.env.newEpisodes(scanIds, viewpointIds, headings, env_ids=env_ids)
+        return self._get_obs(env_ids)
+
     def step(self, actions):
         ''' Take action (same interface as makeActions) '''
         self.env.makeActions(actions)
         return self._get_obs()
 
     ############### Nav Evaluation ###############
-    def _get_nearest(self, shortest_distances, goal_id, path):
-        near_id = path[0]
-        near_d = shortest_distances[near_id][goal_id]
-        for item in path:
-            d = shortest_distances[item][goal_id]
-            if d < near_d:
-                near_id = item
-                near_d = d
-        return near_id
-
-    def _eval_r2r_item(self, scan, pred_path, gt_path):
+    def _eval_r2r_item(self, scan, pred_path, gt_path, dtw=True):
         scores = {}
 
-        shortest_distances = self.shortest_distances[scan]
+        scan_paths = self.scan_paths[scan]
+        shortest_distances = scan_paths.distances
 
         path = sum(pred_path, [])
         assert gt_path[0] == path[0], 'Result trajectories should include the start position'
 
-        nearest_position = self._get_nearest(shortest_distances, gt_path[-1], path)
+        path_idx = np.array([scan_paths.index[vp] for vp in path])
+        gt_idx = np.array([scan_paths.index[vp] for vp in gt_path])
 
-        scores['nav_error'] = shortest_distances[path[-1]][gt_path[-1]]
-        scores['oracle_error'] = shortest_distances[nearest_position][gt_path[-1]]
+        # distances to the goal along the path, the nearest position gives the oracle error
+        goal_distances = shortest_distances[path_idx, gt_idx[-1]].astype(np.float64)
+
+        scores['nav_error'] = goal_distances[-1]
+        scores['oracle_error'] = goal_distances.min()
 
         scores['action_steps'] = len(pred_path) - 1
         scores['trajectory_steps'] = len(path) - 1
-        scores['trajectory_lengths'] = np.sum([shortest_distances[a][b] for a, b in zip(path[:-1], path[1:])])
+        scores['trajectory_lengths'] = shortest_distances[path_idx[:-1], path_idx[1:]].astype(np.float64).sum()
+
+        gt_lengths = shortest_distances[gt_idx[:-1], gt_idx[1:]].astype(np.float64).sum()
 
-        gt_lengths = np.sum([shortest_distances[a][b] for a, b in zip(gt_path[:-1], gt_path[1:])])
-        
         scores['success'] = float(scores['nav_error'] < ERROR_MARGIN)
         scores['spl'] = scores['success'] * gt_lengths / max(scores['trajectory_lengths'], gt_lengths, 0.01)
         scores['oracle_success'] = float(scores['oracle_error'] < ERROR_MARGIN)
 
-        scores.update(
-            cal_dtw(shortest_distances, path, gt_path, scores['success'], ERROR_MARGIN)
-        )
-        scores['CLS'] = cal_cls(shortest_distances, path, gt_path, ERROR_MARGIN)
+        if dtw:
+            dtw_scores = cal_dtw_batch(
+                [shortest_distances], [path_idx], [gt_idx], [scores['success']], ERROR_MARGIN
+            )
+            scores.update({k: v[0] for k, v in dtw_scores.items()})
+        scores['CLS'] = cal_cls_idx(shortest_distances, path_idx, gt_idx, ERROR_MARGIN)
 
-        return scores
+        return scores, path_idx, gt_idx
 
     def eval_metrics(self, preds, dataset):
         ''' Evaluate each r2r trajectory based on how close it got to the goal location
@@ -347,17 +352,28 @@ class R2RNavBatch(object):
         print('eval %d predictions' % (len(preds)))
 
         metrics = defaultdict(list)
+        distances, path_idxs, gt_idxs = [], [], []
         for item in preds:
             instr_id = item['instr_id']
             traj = item['trajectory']
 
             scan, gt_traj = self.gt_trajs[instr_id]
-            traj_scores = self._eval_r2r_item(scan, traj, gt_traj)
+            traj_scores, path_idx, gt_idx = self._eval_r2r_item(scan, traj, gt_traj, dtw=False)
 
             for k, v in traj_scores.items():
                 metrics[k].append(v)
             metrics['instr_id'].append(instr_id)
 
+            distances.append(self.scan_paths[scan].distances)
+            path_idxs.append(path_idx)
+            gt_idxs.append(gt_idx)
+
+        # DTW of all trajectories in one pass
+        if len(preds) > 0:
+            dtw_scores = cal_dtw_batch(distances, path_idxs, gt_idxs, metrics['success'], ERROR_MARGIN)
+            for k, v in dtw_scores.items():
+                metrics[k] = list(v)
+
         avg_metrics = {
             # 'action_steps': np.mean(metrics['action_steps']),
             'steps': np.mean(metrics['trajectory_steps']),
@@ -370,4 +386,3 @@ class R2RNavBatch(object):
         }
 
         return avg_metrics, metrics
-
@@ -3,21 +3,50 @@
 import numpy as np
 
 
-def cal_dtw(shortest_distances, prediction, reference, success=None, threshold=3.0):
-    dtw_matrix = np.inf * np.ones((len(prediction) + 1, len(reference) + 1))
-    dtw_matrix[0][0] = 0
-    for i in range(1, len(prediction)+1):
-        for j in range(1, len(reference)+1):
-            best_previous_cost = min(
-                dtw_matrix[i-1][j], dtw_matrix[i][j-1], dtw_matrix[i-1][j-1])
-            cost = shortest_distances[prediction[i-1]][reference[j-1]]
-            dtw_matrix[i][j] = cost + best_previous_cost
-
-    dtw = dtw_matrix[len(prediction)][len(reference)]
-    ndtw = np.exp(-dtw/(threshold * len(reference)))
-    if success is None:
-        success = float(shortest_distances[prediction[-1]][reference[-1]] < threshold)
-    sdtw = success * ndtw
+def dtw_batch(cost_matrices):
+    """
+    DTW distances of a list of (len(prediction), len(reference)) cost matrices.
+    All matrices are padded into one array and filled together along the anti-diagonals,
+    as every cell only depends on cells of the two previous diagonals.
+    """
+    batch_size = len(cost_matrices)
+    lens_p = np.array([c.shape[0] for c in cost_matrices])
+    lens_r = np.array([c.shape[1] for c in cost_matrices])
+    n, m = lens_p.max(), lens_r.max()
+
+    costs = np.full((batch_size, n, m), np.inf)
+    for b, c in enumerate(cost_matrices):
+        costs[b, :c.shape[0], :c.shape[1]] = c
+
+    dtw_matrix = np.full((batch_size, n + 1, m + 1), np.inf)
+    dtw_matrix[:, 0, 0] = 0
+    for d in range(2, n + m + 1):
+        i = np.arange(max(1, d - m), min(n, d - 1) + 1)
+        j = d - i
+        best_previous_cost = np.minimum(
+            np.minimum(dtw_matrix[:, i-1, j], dtw_matrix[:, i, j-1]), dtw_matrix[:, i-1, j-1])
+        dtw_matrix[:, i, j] = costs[:, i-1, j-1] + best_previous_cost
+
+    return dtw_matrix[np.arange(batch_size), lens_p, lens_r]
+
+
+def cal_dtw_batch(distances, predictions, references, successes=None, threshold=3.0):
+    """
+    DTW, normalized DTW and success weighted DTW of many trajectories at once.
+    :param distances: per-trajectory (V, V) shortest distance matrices (e.g. ScanShortestPaths.distances)
+    :param predictions, references: per-trajectory arrays of viewpoint indices into the matrices
+    :return: {'DTW': array, 'nDTW': array, 'SDTW': array}
+    """
+    cost_matrices = [
+        dist[np.ix_(pred, ref)].astype(np.float64) for dist, pred, ref in zip(distances, predictions, references)
+    ]
+    dtw = dtw_batch(cost_matrices)
+    ndtw = np.exp(-dtw / (threshold * np.array([len(ref) for ref in references])))
+    if successes is None:
+        successes = [
+            float(dist[pred[-1], ref[-1]] < threshold) for dist, pred, ref in zip(distances, predictions, references)
+        ]
+    sdtw = np.array(successes) * ndtw
 
     return {
         'DTW': dtw,
@@ -25,19 +54,48 @@ def cal_dtw(shortest_distances, prediction, reference, success=None, threshold=3
         'SDTW': sdtw
     }
 
-def cal_cls(shortest_distances, prediction, reference, threshold=3.0):
+
+def cal_cls_idx(distances, prediction, reference, threshold=3.0):
+    ''' Coverage weighted by length score (CLS) of viewpoint index arrays into a (V, V) shortest distance matrix '''
     def length(nodes):
-      return np.sum([
-          shortest_distances[a][b]
-          for a, b in zip(nodes[:-1], nodes[1:])
-      ])
-
-    coverage = np.mean([
-        np.exp(-np.min([  # pylint: disable=g-complex-comprehension
-            shortest_distances[u][v] for v in prediction
-        ]) / threshold) for u in reference
-    ])
+        return distances[nodes[:-1], nodes[1:]].astype(np.float64).sum()
+
+    coverage = np.mean(
+        np.exp(-distances[np.ix_(reference, prediction)].astype(np.float64).min(axis=1) / threshold)
+    )
     expected = coverage * length(reference)
     score = expected / (expected + np.abs(expected - length(prediction)))
     return coverage * score
-    
+
+
+class MetricsAccumulator(object):
+    ''' Running sums of the per-trajectory scores of eval_metrics, giving the averages at any time '''
+
+    def __init__(self):
+        self.count = 0
+        self.sums = {}
+
+    def update(self, scores):
+        """ scores: {metric: value} of one finished trajectory """
+        self.count += 1
+        for k, v in scores.items():
+            self.sums[k] = self.sums.get(k, 0.) + v
+
+    def mean(self, k):
+        return self.sums[k] / self.count
+
+    def summary(self):
+        if self.count == 0:
+            return {}
+        return {
+            'steps': self.mean('trajectory_steps'),
+            'lengths': self.mean('trajectory_lengths'),
+            'nav_error': self.mean('nav_error'),
+            'oracle_error': self.mean('oracle_error'),
+            'sr': self.mean('success') * 100,
+            'oracle_sr': self.mean('oracle_success') * 100,
+            'spl': self.mean('spl') * 100,
+            'ndtw': self.mean('nDTW') * 100,
+            'sdtw': self.mean('SDTW') * 100,
+            'cls': self.mean('CLS') * 100,
+        }
@@ -1,9 +1,17 @@
 import sys
+import math
+import time
 import numpy as np
 from collections import defaultdict
 from GPT.one_stage_prompt_manager import OneStagePromptManager
+from GPT.image_budget import ImageBudget
 from .agent_base import BaseAgent
-from GPT.api import gpt_infer
+from .prefetch import Prefetcher
+from .policies import build_policy
+from .graph_env import turn_angles
+from GPT.api import gpt_infer, token_cost, cached_tokens, get_backend
+from GPT.streaming import wait_pending, then
+from utils.journal import save_checkpoint, load_checkpoint
 import json
 
 
@@ -26,6 +34,15 @@ class GPTNavAgent(BaseAgent):
         self.args = args
 
         self._build_prompt_manager()
+        self.capabilities = get_backend().capabilities(args.llm)
+        if args.response_format == 'json' and not self.capabilities.supports_json:
+            raise ValueError('%s does not support the JSON mode, use --response_format str' % args.llm)
+        self.max_images = args.max_images
+        if self.capabilities.max_images is not None:
+            self.max_images = min(self.max_images, self.capabilities.max_images)
+        self.image_budget = ImageBudget(self.max_images, args.image_token_budget, args.image_policy, args.tile_size)
+        self.prefetcher = Prefetcher(args.img_root) if args.prefetch else None
+        self.policy = build_policy(args)    # None: the LLM
 
         # Logs
         sys.stdout.flush()
@@ -35,7 +52,72 @@ class GPTNavAgent(BaseAgent):
         self.prompt_manager = OneStagePromptManager(self.args)
         print('Model version:', self.args.llm)
 
-    def make_equiv_action(self, a_t, obs, traj=None):
+    def make_equiv_action(self, a_t, obs, traj=None, env_ids=None):
+        if self.args.action_mode == 'turn':
+            self.make_equiv_action_by_turning(a_t, obs, traj, env_ids)
+        else:
+            self.make_equiv_action_by_teleport(a_t, obs, traj, env_ids)
+
+    def turned_angles(self, previous_angle, obs, a_t):
+        '''
+        Heading and elevation the prompts see after the action: those of the turning path, bit for bit,
+        also when teleporting or after a resume, where the simulator snaps them (see turn_angles)
+        '''
+        angles = []
+        for angle, ob, action in zip(previous_angle, obs, a_t):
+            if action == -1:
+                angles.append(angle)
+                continue
+            heading, elevation = turn_angles(angle['heading'], angle['elevation'],
+                                             ob['viewIndex'], ob['candidate'][action].pointId)
+            angles.append({'heading': heading, 'elevation': elevation})
+        return angles
+
+    def make_equiv_action_by_teleport(self, a_t, obs, traj=None, env_ids=None):
+        '''
+        Move every agent straight to its target viewpoint, looking at the view of the candidate
+        like the turning path would, with one newEpisode call per simulator.
+        In 'verify' mode the turning path is run first and the final states are checked, and
+        turn_angles, which gives the prompts their angles, has to reproduce its turns exactly.
+        '''
+        moves = []
+        for k, ob in enumerate(obs):
+            i = k if env_ids is None else env_ids[k]
+            if a_t[k] != -1:
+                select_candidate = ob['candidate'][a_t[k]]
+                moves.append((k, i, ob['scan'], select_candidate['viewpointId'], select_candidate['pointId']))
+        if len(moves) == 0:
+            return
+
+        if self.args.action_mode == 'verify':
+            self.make_equiv_action_by_turning(a_t, obs, env_ids=env_ids)
+            expected = self.env.env.getStates([i for _, i, _, _, _ in moves])
+
+        self.env.env.newEpisodes(
+            [scan for _, _, scan, _, _ in moves],
+            [vp for _, _, _, vp, _ in moves],
+            [(point % 12) * math.radians(30) for _, _, _, _, point in moves],
+            env_ids=[i for _, i, _, _, _ in moves],
+            elevations=[(point // 12 - 1) * math.radians(30) for _, _, _, _, point in moves],
+        )
+
+        if self.args.action_mode == 'verify':
+            for (k, i, _, vp, point), state_a in zip(moves, expected):
+                state_b = self.env.env.sims[i].getState()[0]
+                assert state_a.location.viewpointId == state_b.location.viewpointId == vp
+                assert state_a.viewIndex == state_b.viewIndex == point
+                # the simulator snaps the heading of new episodes, turning accumulates it
+                assert abs(math.remainder(state_a.heading - state_b.heading, 2 * math.pi)) < 1e-6
+                assert abs(state_a.elevation - state_b.elevation) < 1e-6
+                angles = turn_angles(obs[k]['heading'], obs[k]['elevation'], obs[k]['viewIndex'], point)
+                assert angles == (state_a.heading, state_a.elevation), \
+                    'turn_angles gives %r, turning reached %r' % (angles, (state_a.heading, state_a.elevation))
+
+        if traj is not None:
+            for k, _, _, vp, _ in moves:
+                traj[k]['path'].append([vp])
+
+    def make_equiv_action_by_turning(self, a_t, obs, traj=None, env_ids=None):
 
         def take_action(i, name):
             if type(name) is int:       # Go to the next viewpoint
@@ -43,8 +125,9 @@ class GPTNavAgent(BaseAgent):
             else:                       # Adjust
                 self.env.env.sims[i].makeAction(*self.env_actions[name])
 
-        for i, ob in enumerate(obs):
-            action = a_t[i]
+        for k, ob in enumerate(obs):
+            i = k if env_ids is None else env_ids[k]    # simulator of the k-th observation
+            action = a_t[k]
             if action != -1:            # -1 is the <stop> action
                 select_candidate = ob['candidate'][action]
                 src_point = ob['viewIndex']
@@ -65,26 +148,135 @@ class GPTNavAgent(BaseAgent):
 
                 state = self.env.env.sims[i].getState()[0]
                 if traj is not None:
-                    traj[i]['path'].append([state.location.viewpointId])
+                    traj[k]['path'].append([state.location.viewpointId])
 
-    def rollout(self, train_ml=None, train_rl=False, reset=True):
-        if reset:  # Reset env
-            obs = self.env.reset()
+    def get_llm_request(self, nav_input, image_list):
+        """
+        Build the gpt_infer arguments of the current step.
+        Returns None if the query exceeds the image limit of the model and the episode has to stop.
+        """
+        environment_prompts = nav_input["prompts"][0]
+        layout = {}
+        if self.args.prompt_layout == 'prefix_stable':
+            # the instruction goes ahead of the images, the rest of the prompt after them
+            prefix = nav_input["prompt_prefixes"][0]
+            layout = dict(prefix_text=prefix)
+            environment_prompts = environment_prompts[len(prefix) + 1:]
+
+        if self.args.image_policy == 'stop' and self.capabilities.max_images is not None \
+                and len(image_list) > self.max_images:
+            # e.g. GPT-4o currently does not support queries with more than 20 images
+            return None
+
+        request = dict(system=nav_input["task_description"], text=environment_prompts, image_list=image_list,
+                       model=self.args.llm, max_tokens=self.args.max_tokens, **layout)
+        if self.args.response_format == 'json':
+            request['response_format'] = {"type": "json_object"}
+        if self.args.llm_stream:
+            request.update(stream=True, early_cutoff=self.args.llm_early_cutoff)
+        return request
+
+    def select_images(self, prompt_manager, cand_vpids):
+        '''
+        Images of the request under the image budget. The candidates are always sent, then the
+        unvisited places from the most recently observed, then the visited ones from the most recently visited.
+        '''
+        node_index = prompt_manager.node_index[0]
+        keep = [node_index[vp] for vp in cand_vpids]
+        order = [node_index[vp] for vp in reversed(list(prompt_manager.unvisited[0]))]
+        visited = set()
+        for vp in reversed(prompt_manager.trajectory[0]):
+            if vp not in visited:
+                visited.add(vp)
+                order.append(node_index[vp])
+        return self.image_budget.select(prompt_manager.node_imgs[0], keep, order)
+
+    def parse_llm_output(self, prompt_manager, nav_output, nav_input, t):
+        if self.args.response_format == 'str':
+            nav_output = [nav_output]
+            a_t = prompt_manager.parse_action(nav_output=nav_output,
+                                              only_options_batch=nav_input["only_options"],
+                                              t=t)
+            prompt_manager.parse_planning(nav_output=nav_output)
         else:
-            obs = self.env._get_obs()
+            json_output = json.loads(nav_output)
+            a_t = prompt_manager.parse_json_action(json_output, nav_input["only_options"], t)
+            prompt_manager.parse_json_planning(json_output)
+        return a_t
 
-        batch_size = len(obs)
+    def record_step(self, instr_id, t, tokens, step_stats):
+        if self.step_recorder is None:
+            return
+        if hasattr(tokens, 'add_done_callback'):
+            # a streamed completion still generating after its action was committed, see eval_all_cases
+            then(tokens, lambda usage: self.record_step(instr_id, t, usage, step_stats))
+            return
+        if tokens is not None:
+            step_stats['prompt_tokens'] = tokens.prompt_tokens
+            step_stats['completion_tokens'] = tokens.completion_tokens
+            step_stats['cached_tokens'] = cached_tokens(tokens)
+            if not step_stats.get('cached'):
+                step_stats['cost'] = token_cost(self.args.llm, tokens.prompt_tokens, tokens.completion_tokens,
+                                                step_stats['cached_tokens'])
+        self.step_recorder.record(instr_id=instr_id, t=t, model=self.args.llm, **step_stats)
 
+    def eval_all_cases(self, args):
+        wait_pending()
+        super().eval_all_cases(args)
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+    def init_traj(self, obs):
         # Record the navigation path
-        traj = [{
+        return [{
             'instr_id': ob['instr_id'],
             'path': [[ob['viewpoint']]],
             'details': {},
             'a_t': {},
         } for ob in obs]
 
-        if traj[0]['instr_id'] in self.results:
-            return [None]
+    def save_checkpoint(self, prompt_manager, obs, traj, t, previous_angle):
+        ''' Save the state of an episode after step t, to resume it without repeating LLM calls '''
+        if self.checkpoint_dir is None:
+            return
+        save_checkpoint(self.checkpoint_path(traj[0]['instr_id']), {
+            't': t,
+            'scan': obs[0]['scan'],
+            'viewpoint': obs[0]['viewpoint'],
+            'viewIndex': obs[0]['viewIndex'],
+            # the exact angles of the prompts, the simulator snaps the heading of the restored episode
+            'previous_angle': previous_angle[0],
+            'traj': traj[0],
+            'prompt_manager': prompt_manager.state_dict(),
+        })
+
+    def restore_checkpoint(self, obs, traj, env_ids=None):
+        ''' Move the agent to the state of the checkpoint of its episode, if any '''
+        if self.checkpoint_dir is None:
+            return obs, None
+        checkpoint = load_checkpoint(self.checkpoint_path(traj[0]['instr_id']))
+        if checkpoint is None:
+            return obs, None
+
+        traj[0]['path'] = checkpoint['traj']['path']
+        traj[0]['a_t'] = {int(t): a for t, a in checkpoint['traj']['a_t'].items()}
+        traj[0]['details'] = checkpoint['traj']['details']
+
+        view_index = checkpoint['viewIndex']
+        self.env.env.newEpisodes(
+            [checkpoint['scan']], [checkpoint['viewpoint']], [(view_index % 12) * math.radians(30)],
+            env_ids=env_ids, elevations=[(view_index // 12 - 1) * math.radians(30)]
+        )
+        print('Resume %s from step %d' % (traj[0]['instr_id'], checkpoint['t'] + 1))
+        return self.env._get_obs(env_ids), checkpoint
+
+    def navigate(self, prompt_manager, obs, traj, env_ids=None, checkpoint=None):
+        """
+        Navigation loop of one episode, written as a generator so that the way LLM queries are
+        issued is up to the caller: each query is yielded as the keyword arguments of gpt_infer,
+        and the caller sends back its (nav_output, tokens). With a --policy, it answers instead.
+        """
+        batch_size = len(obs)
 
         # Initialization the tracking state
         ended = np.array([False] * batch_size)
@@ -93,58 +285,56 @@ class GPTNavAgent(BaseAgent):
         previous_angle = [{'heading': ob['heading'],
                                'elevation': ob['elevation']} for ob in obs]
 
-        self.prompt_manager.history = ['' for _ in range(self.args.batch_size)]
-        self.prompt_manager.nodes_list = [[] for _ in range(self.args.batch_size)]
-        self.prompt_manager.node_imgs = [[] for _ in range(self.args.batch_size)]
-        self.prompt_manager.graph = [{} for _ in range(self.args.batch_size)]
-        self.prompt_manager.trajectory = [[] for _ in range(self.args.batch_size)]
-        self.prompt_manager.planning = [["Navigation has just started, with no planning yet."] for _ in range(self.args.batch_size)]
+        prompt_manager.reset(batch_size)
+        start_t = 0
+        if checkpoint is not None:
+            prompt_manager.load_state_dict(checkpoint['prompt_manager'])
+            start_t = checkpoint['t'] + 1
+            if 'previous_angle' in checkpoint:
+                previous_angle = [checkpoint['previous_angle']]
 
-        for t in range(self.args.max_action_len):
+        for t in range(start_t, self.args.max_action_len):
             if t == self.args.max_action_len:
                 break
 
-            cand_inputs = self.prompt_manager.make_action_prompt(obs, previous_angle)
+            step_start = time.time()
+            cand_inputs = prompt_manager.make_action_prompt(obs, previous_angle)
             if self.args.response_format == 'str':
-                nav_input = self.prompt_manager.make_r2r_prompts(cand_inputs=cand_inputs, obs=obs, t=t)
+                nav_input = prompt_manager.make_r2r_prompts(cand_inputs=cand_inputs, obs=obs, t=t)
             elif self.args.response_format == 'json':
-                nav_input = self.prompt_manager.make_r2r_json_prompts(cand_inputs=cand_inputs, obs=obs, t=t)
+                nav_input = prompt_manager.make_r2r_json_prompts(cand_inputs=cand_inputs, obs=obs, t=t)
             else:
                 raise NotImplemented
 
-            image_list = self.prompt_manager.node_imgs[0]
+            image_list, image_labels = prompt_manager.node_imgs[0], None
+            if self.args.image_policy != 'stop':
+                image_list, image_labels = self.select_images(prompt_manager, cand_inputs['cand_vpids'][0])
             environment_prompts = nav_input["prompts"][0]
             print('-------------------- Environment Prompts --------------------')
             print(environment_prompts)
 
-            if self.args.llm == 'gpt-4-vision-preview' and self.args.response_format == 'str':
-                # GPT-4V only supports string mode output
-                nav_output, tokens = gpt_infer(nav_input["task_description"], environment_prompts, image_list,
-                                               self.args.llm, self.args.max_tokens)
+            request = self.get_llm_request(nav_input, image_list)
+            step_stats = {'prompt_time': time.time() - step_start}
+            tokens = None
+            if request is None:
+                a_t = [0]
+                print('Exceed image limit and stop!')
+            else:
+                if image_labels is not None:
+                    request['image_labels'] = image_labels
+                request['stats'] = step_stats
+                if self.prefetcher is not None:
+                    self.prefetcher.prefetch(self.env, obs[0])
+                if self.policy is not None:
+                    nav_output, tokens = self.policy.act(self.env, request, obs[0], nav_input,
+                                                         cand_inputs['cand_vpids'][0], t)
+                else:
+                    nav_output, tokens = yield request
                 print('-------------------- Output --------------------')
                 print(nav_output)
-                nav_output = [nav_output]
-                a_t = self.prompt_manager.parse_action(nav_output=nav_output,
-                                                       only_options_batch=nav_input["only_options"],
-                                                       t=t)
-                self.prompt_manager.parse_planning(nav_output=nav_output)
-
-            elif self.args.llm == 'gpt-4o-2024-05-13' and self.args.response_format == 'json':
-                if len(image_list) > 20:
-                    # GPT-4o currently does not support queries with more than 20 images
-                    a_t = [0]
-                    print('Exceed image limit and stop!')
-                else:
-                    nav_output, tokens = gpt_infer(nav_input["task_description"], environment_prompts, image_list,
-                                                   self.args.llm, self.args.max_tokens, response_format={"type": "json_object"})
-                    json_output = json.loads(nav_output)
-                    a_t = self.prompt_manager.parse_json_action(json_output, nav_input["only_options"], t)
-                    self.prompt_manager.parse_json_planning(json_output)
-                    print('-------------------- Output --------------------')
-                    print(nav_output)
-
-            else:
-                raise NotImplemented
+                tic = time.time()
+                a_t = self.parse_llm_output(prompt_manager, nav_output, nav_input, t)
+                step_stats['parse_time'] = time.time() - tic
 
             for i in range(batch_size):
                 traj[i]['a_t'][t] = a_t[i]
@@ -161,16 +351,41 @@ class GPTNavAgent(BaseAgent):
                 else:
                     cpu_a_t.append(a_t[i] - 1)
 
-            self.make_equiv_action(cpu_a_t, obs, traj)
-            obs = self.env._get_obs()
+            tic = time.time()
+            angles = self.turned_angles(previous_angle, obs, cpu_a_t)
+            self.make_equiv_action(cpu_a_t, obs, traj, env_ids)
+            obs = self.env._get_obs(env_ids)
+            step_stats['sim_time'] = time.time() - tic
+            step_stats['step_time'] = time.time() - step_start
+            self.record_step(traj[0]['instr_id'], t, tokens, step_stats)
 
-            previous_angle = [{'heading': ob['heading'],
-                               'elevation': ob['elevation']} for ob in obs]
+            previous_angle = angles
 
             # we only implement batch_size=1
             if a_t[0] == 0:
                 break
 
-            self.prompt_manager.make_history(a_t, nav_input, t)
+            prompt_manager.make_history(a_t, nav_input, t)
+            self.save_checkpoint(prompt_manager, obs, traj, t, previous_angle)
+
+    def rollout(self, train_ml=None, train_rl=False, reset=True):
+        if reset:  # Reset env
+            obs = self.env.reset()
+        else:
+            obs = self.env._get_obs()
+
+        traj = self.init_traj(obs)
+
+        if traj[0]['instr_id'] in self.results:
+            return [None]
+
+        obs, checkpoint = self.restore_checkpoint(obs, traj)
+        navigation = self.navigate(self.prompt_manager, obs, traj, checkpoint=checkpoint)
+        try:
+            request = next(navigation)
+            while True:
+                request = navigation.send(gpt_infer(**request))
+        except StopIteration:
+            pass
 
         return traj
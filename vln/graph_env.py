@@ -0,0 +1,137 @@
+''' Simulator-free navigation environment on the connectivity graphs '''
+import math
+
+
+HEADING_COUNT = 12
+VIEW_COUNT = 36
+HEADING_INCREMENT = math.pi * 2.0 / HEADING_COUNT
+ELEVATION_INCREMENT = math.pi / 6.0
+
+
+class Location(object):
+    __slots__ = ('viewpointId', 'x', 'y', 'z', 'rel_heading', 'rel_elevation', 'rel_distance')
+
+    def __init__(self, viewpointId, position, rel_heading=0., rel_elevation=0., rel_distance=0.):
+        self.viewpointId = viewpointId
+        self.x, self.y, self.z = position
+        self.rel_heading = rel_heading
+        self.rel_elevation = rel_elevation
+        self.rel_distance = rel_distance
+
+
+class SimState(object):
+    __slots__ = ('scanId', 'step', 'location', 'viewIndex', 'heading', 'elevation', 'navigableLocations')
+
+
+def turn_angles(heading, elevation, src_point, trg_point):
+    """
+    Heading and elevation reached by make_equiv_action_by_turning from view src_point to view trg_point
+    (up or down, then right), with the floating-point arithmetic of MatterSim.makeAction. The turns
+    accumulate rounding errors that a newEpisode at trg_point snaps away.
+    """
+    src_level, trg_level = src_point // HEADING_COUNT, trg_point // HEADING_COUNT
+    for _ in range(trg_level - src_level):
+        elevation += ELEVATION_INCREMENT
+    for _ in range(src_level - trg_level):
+        elevation -= ELEVATION_INCREMENT
+    for _ in range((trg_point - src_point) % HEADING_COUNT):
+        heading = math.fmod(heading + HEADING_INCREMENT, math.pi * 2.0)
+        while heading < 0.0:
+            heading += math.pi * 2.0
+    return heading, elevation
+
+
+class GraphSimulator(object):
+    """
+    Drop-in replacement of a MatterSim.Simulator with discretized viewing angles and rendering disabled.
+    Heading and elevation follow the same arithmetic as MatterSim. The navigable locations of a view
+    come from the precomputed candidate tables (vln/candidates.py): a location sits at its 'idx' in
+    the view where it is closest to the center, and the other indices are None.
+    """
+
+    def __init__(self, positions, candidate_tables):
+        self.positions = positions
+        self.candidate_tables = candidate_tables
+        self.state = None
+
+    def newEpisode(self, scanIds, viewpointIds, headings, elevations):
+        scanId, viewpointId, heading, elevation = scanIds[0], viewpointIds[0], headings[0], elevations[0]
+
+        state = SimState()
+        state.scanId = scanId
+        state.step = 0
+        state.location = Location(viewpointId, self.positions[scanId][viewpointId])
+
+        # Snap heading to nearest discrete value
+        heading_step = int(math.copysign(math.floor(abs(heading) / HEADING_INCREMENT + 0.5), heading))
+        if heading_step == HEADING_COUNT:
+            heading_step = 0
+        state.heading = heading_step * HEADING_INCREMENT
+        # Snap elevation to nearest discrete value
+        if elevation < -ELEVATION_INCREMENT / 2.0:
+            state.elevation = -ELEVATION_INCREMENT
+            state.viewIndex = heading_step
+        elif elevation > ELEVATION_INCREMENT / 2.0:
+            state.elevation = ELEVATION_INCREMENT
+            state.viewIndex = heading_step + 2 * HEADING_COUNT
+        else:
+            state.elevation = 0.0
+            state.viewIndex = heading_step + HEADING_COUNT
+
+        self.state = state
+        self._update_navigable_locations()
+
+    def makeAction(self, indices, headings, elevations):
+        state = self.state
+        index, heading, elevation = indices[0], headings[0], elevations[0]
+
+        if index > 0:
+            target = state.navigableLocations[index]
+            state.location = Location(target.viewpointId, self.positions[state.scanId][target.viewpointId])
+            state.step += 1
+
+        # Increments based on sign of input
+        if heading > 0.0:
+            state.heading += HEADING_INCREMENT
+            state.viewIndex += 1
+            if state.viewIndex % HEADING_COUNT == 0:
+                state.viewIndex -= HEADING_COUNT
+        elif heading < 0.0:
+            state.heading -= HEADING_INCREMENT
+            if state.viewIndex % HEADING_COUNT == 0:
+                state.viewIndex += HEADING_COUNT
+            state.viewIndex -= 1
+        if elevation > 0.0 and state.viewIndex < VIEW_COUNT - HEADING_COUNT:
+            state.elevation += ELEVATION_INCREMENT
+            state.viewIndex += HEADING_COUNT
+        elif elevation < 0.0 and state.viewIndex >= HEADING_COUNT:
+            state.elevation -= ELEVATION_INCREMENT
+            state.viewIndex -= HEADING_COUNT
+
+        # Normalize heading to [0, 2pi]
+        state.heading = math.fmod(state.heading, math.pi * 2.0)
+        while state.heading < 0.0:
+            state.heading += math.pi * 2.0
+
+        self._update_navigable_locations()
+
+    def _update_navigable_locations(self):
+        state = self.state
+        rows = self.candidate_tables.get(state.scanId, state.location.viewpointId)
+        if rows is None:
+            raise KeyError('%s_%s is missing from the candidate tables, run python -m vln.candidates'
+                           % (state.scanId, state.location.viewpointId))
+
+        navigable = [state.location]
+        for (cand_vp, ix, idx, _, _, rel_heading, rel_elevation, position) in rows:
+            if ix != state.viewIndex:
+                continue
+            if idx >= len(navigable):
+                navigable.extend([None] * (idx + 1 - len(navigable)))
+            x, y, z = position
+            distance = math.sqrt((x - state.location.x) ** 2 + (y - state.location.y) ** 2 + (z - state.location.z) ** 2)
+            navigable[idx] = Location(cand_vp, position, rel_heading, rel_elevation, distance)
+        state.navigableLocations = navigable
+
+    def getState(self):
+        return [self.state]
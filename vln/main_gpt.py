@@ -1,53 +1,80 @@
 import os
 import json
 import time
+import queue
+import multiprocessing
 from collections import defaultdict
 
-from vln.data_utils import construct_instrs
+from vln.data_utils import open_instrs, open_annotations, index_dir, shard_range
 from vln.env import R2RNavBatch
 from vln.parser import parse_args
 
 from utils.data import set_random_seed
-from utils.logger import write_to_record_file
+from utils.logger import write_to_record_file, load_step_records, summarize_steps, format_step_summary
+from vln.eval_utils import MetricsAccumulator
 
 from vln.gpt_agent import GPTNavAgent
+from vln.async_agent import AsyncGPTNavAgent
+from vln.batch_agent import BatchGPTNavAgent
 
+from GPT.api import generation_key, get_backend, set_backend, set_response_cache, set_image_encoder, set_request_limiter
+from GPT.backends import build_backend
+from GPT.cache import ResponseCache
+from GPT.image_cache import ImageEncoder, ImageStore
+from GPT.rate_limiter import RateLimiter
+from GPT import streaming
 
-def build_dataset(args, rank=0, is_test=True):
+
+def build_dataset(args, rank=0, is_test=True, sel_data_idxs=None):
     dataset_class = R2RNavBatch
     split = args.split
     val_envs = {}
+    name = split if sel_data_idxs is None else '%s_shard%dof%d' % (split, sel_data_idxs[0], sel_data_idxs[1])
 
     if 'processed' in split:
-        with open(os.path.join(args.anno_dir, split+'.json'), 'r') as f:
-            val_instr_data = json.load(f)
-
+        # only the evaluated range (of the shard) is read, see AnnotationIndex
+        index = open_annotations(os.path.join(args.anno_dir, split + '.json'), index_dir(args.anno_dir))
         if args.end is None:
-            args.end = len(val_instr_data)
-        val_instr_data = val_instr_data[args.start:args.end]
+            args.end = len(index)
+        start, end, _ = slice(args.start, args.end).indices(len(index))
+        if sel_data_idxs is not None:
+            shard_start, shard_end = shard_range(max(end - start, 0), *sel_data_idxs)
+            start, end = start + shard_start, start + shard_end
+            sel_data_idxs = None
+        val_instr_data = index.load(start, end)
         print(f'------------------ Evaluate {args.start}-{args.end} in {split} ------------------')
 
     else:
-        val_instr_data = construct_instrs(
-            args.anno_dir, args.dataset, [split],
-            tokenizer=args.tokenizer, max_instr_len=args.max_instr_len,
-            is_test=is_test
-        )
+        # the whole split, or only the shard, is read
+        index = open_instrs(args.anno_dir, args.dataset, split, args.tokenizer)
+        start, end = 0, len(index)
+        if sel_data_idxs is not None:
+            start, end = shard_range(len(index), *sel_data_idxs)
+            sel_data_idxs = None
+        val_instr_data = index.load(start, end, exclude=('instr_encoding',))
 
+    # the async rollout runs every episode in its own simulator
+    batch_size = max(args.batch_size, args.parallel_episodes)
     val_env = dataset_class(
-        val_instr_data, args.connectivity_dir, batch_size=args.batch_size,
-        seed=args.seed+rank,
-        name=split, args=args,
+        val_instr_data, args.connectivity_dir, batch_size=batch_size,
+        seed=args.seed+rank, sel_data_idxs=sel_data_idxs,
+        name=name, args=args,
     )   # evaluation using all objects
     val_envs[split] = val_env
 
     return val_envs
 
 
+def get_agent_class(args):
+    if args.llm_batch is not None:
+        return BatchGPTNavAgent
+    return AsyncGPTNavAgent if args.parallel_episodes > 1 else GPTNavAgent
+
+
 def valid(args, val_envs, rank=0):
 
     default_gpu = None
-    agent_class = GPTNavAgent
+    agent_class = get_agent_class(args)
 
     agent = agent_class(args, list(val_envs.values())[0], rank=rank)
 
@@ -70,7 +97,9 @@ def valid(args, val_envs, rank=0):
         start_time = time.time()
         print('running...')
         agent.test(args=args)
-        print(env_name, 'cost time: %.2fs' % (time.time() - start_time))
+        cost_time = time.time() - start_time
+        print(env_name, 'cost time: %.2fs, %d steps (%.2f steps/s)' % (
+            cost_time, agent.num_steps, agent.num_steps / max(cost_time, 1e-6)))
         preds = agent.get_results(detailed_output=args.detailed_output)
 
         if default_gpu:
@@ -89,12 +118,171 @@ def valid(args, val_envs, rank=0):
                 )
                 
 
+def build_limiter(args, ctx=multiprocessing):
+    if args.max_rpm is None and args.max_tpm is None:
+        return None
+    # AIMD starts from, and never exceeds, the requests the rollout can have in flight
+    max_concurrency = (args.llm_concurrency or args.parallel_episodes) * args.num_workers
+    return RateLimiter(args.max_rpm, args.max_tpm, max_concurrency=max_concurrency, ctx=ctx)
+
+
+def setup_llm(args, limiter=None):
+    api_key = args.llm_api_key or os.environ.get('OPENAI_API_KEY') or generation_key
+    set_backend(build_backend(args, api_key))
+
+    cache = None
+    if args.llm_cache is not None:
+        cache = ResponseCache(args.llm_cache, mode=args.llm_cache_mode, max_size_mb=args.llm_cache_max_mb)
+        set_response_cache(cache)
+
+    image_store = ImageStore(args.image_store, args.img_root) if args.image_store else None
+    set_image_encoder(ImageEncoder(max_size=args.image_cache_size, store=image_store,
+                                   downscale=args.image_downscale))
+
+    if limiter is None:
+        limiter = build_limiter(args)
+    set_request_limiter(limiter)
+    return cache
+
+
+def close_llm(cache):
+    # the completions drained in the background still read from the backend
+    streaming.close()
+    get_backend().close()
+    if cache is not None:
+        print('LLM response cache:', cache.stats())
+        cache.close()
+
+
+def run_shard(args, shard, num_shards, result_queue, limiter):
+    """ Worker process: evaluate one shard with its own simulator and stream the finished cases """
+    set_random_seed(args.seed)
+    cache = setup_llm(args, limiter)
+
+    val_envs = build_dataset(args, sel_data_idxs=(shard, num_shards))
+    env = list(val_envs.values())[0]
+    agent_class = get_agent_class(args)
+    agent = agent_class(args, env)
+    # the shard journal lets a restarted worker skip the cases it already sent
+    agent.case_listener = lambda pred: result_queue.put(('case', shard, pred))
+    agent.test(args=args)
+
+    close_llm(cache)
+    result_queue.put(('done', shard, None))
+
+
+def run_sharded(args):
+    """
+    Split the split into num_workers shards evaluated by separate processes, which share one
+    request rate limit. A shard whose worker dies is restarted and resumes from its journal.
+    The finished cases are merged into one predictions file and one metrics summary.
+    """
+    num_shards = args.num_workers
+    prefix = 'submit' if args.detailed_output is False else 'detail'
+    pred_file = os.path.join(args.pred_dir, "%s_%s.json" % (prefix, args.split))
+    if os.path.exists(pred_file):
+        print('Path already exists...')
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    limiter = build_limiter(args, ctx)
+    result_queue = ctx.Queue()
+
+    def start_worker(shard):
+        worker = ctx.Process(target=run_shard, args=(args, shard, num_shards, result_queue, limiter),
+                             name='shard%d' % shard)
+        worker.start()
+        return worker
+
+    start_time = time.time()
+    workers = {shard: start_worker(shard) for shard in range(num_shards)}
+    restarts = defaultdict(int)
+    shard_preds = defaultdict(dict)
+    running_metrics = MetricsAccumulator()
+    finished = set()
+
+    def check_workers(queue_empty):
+        for shard, worker in workers.items():
+            if shard in finished or worker.is_alive():
+                continue
+            if worker.exitcode == 0:
+                # its last cases and 'done' may still be queued
+                if queue_empty:
+                    finished.add(shard)
+                continue
+            if restarts[shard] >= args.max_worker_restarts:
+                raise RuntimeError('Worker of shard %d died %d times' % (shard, restarts[shard] + 1))
+            restarts[shard] += 1
+            print('Worker of shard %d exited with code %d, restarting (%d/%d)' % (
+                shard, worker.exitcode, restarts[shard], args.max_worker_restarts))
+            workers[shard] = start_worker(shard)
+
+    while len(finished) < num_shards:
+        try:
+            kind, shard, pred = result_queue.get(timeout=1)
+        except queue.Empty:
+            check_workers(queue_empty=True)
+            continue
+        # the other shards may keep the queue busy: a dead worker is restarted without waiting for them
+        check_workers(queue_empty=False)
+
+        if kind == 'done':
+            finished.add(shard)
+            continue
+
+        instr_id = pred['instr_id']
+        if instr_id not in shard_preds[shard]:
+            running_metrics.update({k: v[0] for k, v in pred['evaluation'].items() if k != 'instr_id'})
+        shard_preds[shard][instr_id] = pred
+        loss_str = "Merged (%d cases)  -" % running_metrics.count
+        for metric, val in running_metrics.summary().items():
+            loss_str += '  %s: %.2f' % (metric, val)
+        print(loss_str)
+
+    for worker in workers.values():
+        worker.join()
+    print(args.split, 'cost time: %.2fs' % (time.time() - start_time))
+
+    loss_str = "Env name: %s, %d shards  -" % (args.split, num_shards)
+    for metric, val in running_metrics.summary().items():
+        loss_str += '  %s: %.2f' % (metric, val)
+    record_file = os.path.join(args.log_dir, 'valid.txt')
+    write_to_record_file(loss_str + '\n', record_file)
+    steps = []
+    for shard in range(num_shards):
+        steps.extend(load_step_records(
+            os.path.join(args.log_dir, 'steps_%s_shard%dof%d.jsonl' % (args.split, shard, num_shards))
+        ))
+    write_to_record_file(format_step_summary(summarize_steps(steps)) + '\n', record_file)
+
+    preds = []
+    for shard in range(num_shards):
+        for instr_id, pred in shard_preds[shard].items():
+            preds.append({'instr_id': instr_id, 'trajectory': pred['trajectory'], 'a_t': pred['a_t']})
+            if args.detailed_output:
+                preds[-1]['details'] = pred['details']
+    if args.submit or args.save_pred:
+        json.dump(
+            preds, open(pred_file, 'w'),
+            sort_keys=True, indent=4, separators=(',', ': ')
+        )
+
+
 def main():
     args = parse_args()
     set_random_seed(args.seed)
+
+    if args.num_workers > 1:
+        run_sharded(args)
+        return
+
+    cache = setup_llm(args)
+
     val_envs = build_dataset(args)
     valid(args, val_envs)
 
+    close_llm(cache)
+
 
 if __name__ == '__main__':
     main()
@@ -27,10 +27,61 @@ def parse_args():
     parser.add_argument('--response_format', type=str, default='str', choices=['str', 'json'])
     parser.add_argument('--img_root', type=str, default=None)
     parser.add_argument("--split", type=str, default='MapGPT_72_scenes_processed')
-    parser.add_argument('--start', type=int, default=0)
-    parser.add_argument('--end', type=int, default=None)
+    parser.add_argument('--start', type=int, default=0, help='first case evaluated of a processed split')
+    parser.add_argument('--end', type=int, default=None, help='end of the cases evaluated of a processed split')
     parser.add_argument('--stop_after', type=int, default=3)
     parser.add_argument('--max_tokens', type=int, default=1000)
+    parser.add_argument('--image_policy', type=str, default='stop', choices=['stop', 'drop', 'tile'],
+                        help='over max_images, stop the episode (gpt-4o), drop the least important images, or tile them')
+    parser.add_argument('--max_images', type=int, default=20, help='images per request')
+    parser.add_argument('--image_token_budget', type=int, default=None, help='image tokens per request (85 per image)')
+    parser.add_argument('--tile_size', type=int, default=4, help='images per composite of the tile policy')
+    parser.add_argument('--prompt_layout', type=str, default='default', choices=['default', 'prefix_stable'],
+                        help='prefix_stable: instruction, then images, then per-step text, for provider prompt caching. '
+                             'A place keeps the image it was first observed with.')
+    parser.add_argument('--llm_backend', type=str, default='openai', choices=['openai', 'mock', 'replay'],
+                        help='openai: OpenAI or an OpenAI-compatible server (--llm_base_url); mock: deterministic '
+                             'answers without a server; replay: the answers of --llm_transcript')
+    parser.add_argument('--llm_base_url', type=str, default=None,
+                        help='e.g. http://localhost:8000/v1 for vLLM (default: $OPENAI_BASE_URL or the OpenAI API)')
+    parser.add_argument('--llm_api_key', type=str, default=None,
+                        help='default: $OPENAI_API_KEY, then generation_key of GPT/api.py')
+    parser.add_argument('--llm_max_connections', type=int, default=64, help='pooled keep-alive connections to the server')
+    parser.add_argument('--llm_transcript', type=str, default=None,
+                        help='jsonl file the responses are appended to, or read from with --llm_backend replay')
+    parser.add_argument('--llm_mock_latency', type=float, default=0., help='seconds before each answer of the mock backend')
+    parser.add_argument('--llm_stream', action='store_true', default=False,
+                        help='stream the completions and move as soon as the action is final')
+    parser.add_argument('--llm_early_cutoff', action='store_true', default=False,
+                        help='with --llm_stream, cancel the rest of the completion once the action is final')
+    parser.add_argument('--policy', type=str, default='llm', choices=['llm', 'oracle', 'random', 'replay'],
+                        help='answer without the LLM, to benchmark the pipeline offline (see vln/policies.py)')
+    parser.add_argument('--policy_log', type=str, default=None,
+                        help='results journal (preds/journal_<split>.jsonl) or predictions file replayed by --policy replay')
+    parser.add_argument('--llm_cache', type=str, default=None, help='sqlite file caching the LLM responses')
+    parser.add_argument('--llm_cache_mode', type=str, default='readwrite', choices=['readwrite', 'readonly', 'replay', 'record'])
+    parser.add_argument('--llm_cache_max_mb', type=float, default=None)
+    parser.add_argument('--image_store', type=str, default=None, help='images packed by GPT/image_cache.py')
+    parser.add_argument('--image_cache_size', type=int, default=4096, help='encoded images kept in memory')
+    parser.add_argument('--image_downscale', action='store_true', default=False,
+                        help='resize the images to the "low" detail resolution before encoding, as --image_store packed with --downscale')
+    parser.add_argument('--env_backend', type=str, default='mattersim', choices=['mattersim', 'graph'],
+                        help='graph: simulator-free navigation on the connectivity graphs and candidate tables')
+    parser.add_argument('--action_mode', type=str, default='turn', choices=['turn', 'teleport', 'verify'],
+                        help='reach candidates by turning view by view, by teleporting, or teleport and check against turning')
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help='compute the candidates and encode the images of the next places while the LLM answers')
+    parser.add_argument('--max_cached_scans', type=int, default=None, help='scans whose graphs are kept in memory')
+    parser.add_argument('--journal_fsync_every', type=int, default=1, help='finished cases between fsyncs of the results journal')
+    parser.add_argument('--parallel_episodes', type=int, default=1, help='episodes kept in flight by the async rollout')
+    parser.add_argument('--llm_concurrency', type=int, default=None, help='max concurrent LLM requests (default: parallel_episodes)')
+    parser.add_argument('--llm_batch', type=str, default=None, choices=['openai', 'local'],
+                        help='offline mode: the parallel_episodes episodes advance in lockstep, one batch of requests per step')
+    parser.add_argument('--batch_poll_interval', type=float, default=30, help='seconds between polls of the Batch API')
+    parser.add_argument('--num_workers', type=int, default=1, help='worker processes, each evaluating one shard of the split')
+    parser.add_argument('--max_worker_restarts', type=int, default=3, help='restarts of a shard whose worker died')
+    parser.add_argument('--max_rpm', type=float, default=None, help='LLM requests per minute, shared by all workers')
+    parser.add_argument('--max_tpm', type=float, default=None, help='LLM tokens per minute, shared by all workers')
 
     args, _ = parser.parse_known_args()
 
@@ -43,6 +94,8 @@ def postprocess_args(args):
     ROOTDIR = args.root_dir
 
     args.connectivity_dir = os.path.join(ROOTDIR, 'R2R', 'connectivity')
+    args.graph_cache_dir = os.path.join(ROOTDIR, 'R2R', 'connectivity_cache')
+    args.candidate_dir = os.path.join(ROOTDIR, 'R2R', 'candidates')
     args.scan_data_dir = os.path.join(ROOTDIR, 'Matterport3D', 'v1_unzip_scans')
 
     if args.dataset == 'r2r':
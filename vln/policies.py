@@ -0,0 +1,120 @@
+''' Action policies answering in place of the LLM (--policy), to benchmark the env / prompt / parse
+pipeline without network or API costs.
+
+    oracle  the next place on the shortest path to the goal, then stop
+    random  a uniformly random option, seeded by --seed, the case and the step
+    replay  the actions a_t of an earlier run, from its results journal or predictions file
+
+The request of every step is still built as for the LLM, images included, and the answer goes
+through parse_action / parse_json_action: it is a completion in the --response_format of the run.
+'''
+import json
+import time
+import random
+
+from GPT.api import prepare_request
+from GPT.backends import format_answer
+
+
+class Policy(object):
+    """
+    Chooses the action a_t of a step, as parsed by the prompt manager: 0 is stop,
+    k > 0 is the candidate k - 1. Before args.stop_after, the parser shifts the options by one.
+    """
+
+    name = None
+
+    def __init__(self, args):
+        self.args = args
+
+    def option_offset(self, t):
+        return 1 if bool(self.args.stop_after) and t < self.args.stop_after else 0
+
+    def choose(self, env, ob, cand_vpids, actions, t):
+        ''' :return: one of actions, the a_t the options of the step can express '''
+        raise NotImplementedError
+
+    def act(self, env, request, ob, nav_input, cand_vpids, t):
+        ''' (nav_output, tokens) of the step, in place of gpt_infer(**request) '''
+        request = {k: v for k, v in request.items() if k not in ('stream', 'early_cutoff')}
+        prepare_request(**request)
+
+        tic = time.time()
+        options = nav_input["only_options"][0]
+        offset = self.option_offset(t)
+        actions = [k + offset for k in range(len(options))]
+        a_t = self.choose(env, ob, cand_vpids, actions, t)
+        if request.get('stats') is not None:
+            request['stats']['request_time'] = time.time() - tic
+
+        nav_output = format_answer(options[a_t - offset], request.get('response_format'),
+                                   thought='%s policy.' % self.name.capitalize(),
+                                   planning='Follow the %s policy.' % self.name)
+        return nav_output, None
+
+
+class OraclePolicy(Policy):
+    ''' The next place on the shortest path to the last viewpoint of the ground truth path '''
+
+    name = 'oracle'
+
+    def choose(self, env, ob, cand_vpids, actions, t):
+        goal = ob['gt_path'][-1]
+        if ob['viewpoint'] == goal and 0 in actions:
+            return 0
+
+        moves = [a for a in actions if 0 < a <= len(cand_vpids)]
+        if len(moves) == 0:
+            return actions[0]
+        if ob['viewpoint'] != goal:
+            try:
+                path = env.shortest_paths[ob['scan']][ob['viewpoint']][goal]
+            except KeyError:
+                path = None
+            for a in moves:
+                if path is not None and cand_vpids[a - 1] == path[1]:
+                    return a
+        # at the goal before stopping is allowed, or next place not a candidate: the closest candidate
+        distances = env.shortest_distances[ob['scan']]
+        return min(moves, key=lambda a: distances[cand_vpids[a - 1]][goal])
+
+
+class RandomPolicy(Policy):
+    name = 'random'
+
+    def choose(self, env, ob, cand_vpids, actions, t):
+        # seeded by the step, so that an answer does not depend on the order of the episodes
+        rng = random.Random('%d_%s_%d' % (self.args.seed, ob['instr_id'], t))
+        return rng.choice(actions)
+
+
+class ReplayPolicy(Policy):
+    ''' The a_t of every step of an earlier run, stopping (or taking the first option) past its end '''
+
+    name = 'replay'
+
+    def __init__(self, args):
+        super().__init__(args)
+        if args.policy_log is None:
+            raise ValueError('--policy replay needs --policy_log, a results journal or predictions file')
+        with open(args.policy_log) as f:
+            if args.policy_log.endswith('.jsonl'):
+                records = [json.loads(line) for line in f if line.endswith('\n')]
+            else:
+                records = json.load(f)
+        self.actions = {r['instr_id']: {int(t): a for t, a in r['a_t'].items()} for r in records}
+
+    def choose(self, env, ob, cand_vpids, actions, t):
+        if ob['instr_id'] not in self.actions:
+            raise KeyError('%s is not in %s' % (ob['instr_id'], self.args.policy_log))
+        a_t = self.actions[ob['instr_id']].get(t, 0)
+        return a_t if a_t in actions else actions[0]
+
+
+POLICIES = {policy.name: policy for policy in (OraclePolicy, RandomPolicy, ReplayPolicy)}
+
+
+def build_policy(args):
+    if args.policy == 'llm':
+        return None
+    return POLICIES[args.policy](args)
@@ -0,0 +1,34 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from GPT import api
+
+
+class Prefetcher(object):
+    """
+    While the LLM request of a step is in flight, a background thread computes the candidates of
+    every place the agent can move to and encodes their images, so that the next request is built
+    from the candidate and image caches instead of waiting on the sweep and the encoding.
+    """
+
+    def __init__(self, img_root, max_workers=1):
+        self.img_root = img_root
+        self.max_workers = max_workers
+        self.executor = None
+
+    def prefetch(self, env, ob):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        viewpoints = [cand['viewpointId'] for cand in ob['candidate']]
+        return self.executor.submit(self._prefetch, env, ob['scan'], viewpoints)
+
+    def _prefetch(self, env, scan, viewpoints):
+        for viewpoint in viewpoints:
+            for row in env.get_candidate_rows(scan, viewpoint):
+                api.image_encoder.encode(os.path.join(self.img_root, scan, viewpoint, str(row[1]) + '.jpg'))
+
+    def close(self):
+        ''' Drop the pending work, e.g. at the end of the evaluation '''
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None